@@ -0,0 +1,55 @@
+# -*- coding: utf-8
+#
+# Flight log parsing throughput, columnar reader against the generator
+#
+# Usage: python -m benchmarks.bench_flights [years] [flights per day]
+
+from benchmarks import synth
+from pik.flights import Flight, FlightLog
+import csv
+import datetime as dt
+import random
+import StringIO
+import sys
+import time
+
+def best_time(f, repeat=3):
+    best = None
+    for _ in range(repeat):
+        t0 = time.time()
+        result = f()
+        elapsed = time.time() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def main():
+    years = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    per_day = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    rng = random.Random(1)
+    account_ids = [str(rng.randint(100000, 119999)) for _ in range(500)]
+    aircraft = ["DDS", "CAO", "TOW", "650", "787", "733", "883", "952", "1035", "TK", "755"]
+    end = dt.date(2021, 12, 31)
+    start = dt.date(end.year - years + 1, 1, 1)
+    buf = StringIO.StringIO()
+    csv.writer(buf).writerows(synth.flight_log(rng, aircraft, start, end, per_day, account_ids))
+    data = buf.getvalue()
+    mb = len(data) / float(1 << 20)
+
+    def rows():
+        return csv.reader(StringIO.StringIO(data))
+    t_gen, flights = best_time(lambda: list(Flight.generate_from_csv(rows())))
+    t_log, log = best_time(lambda: FlightLog.from_csv(rows()))
+    t_file, _ = best_time(lambda: FlightLog.from_file(StringIO.StringIO(data)))
+    t_csv, _ = best_time(lambda: sum(1 for _ in rows()))
+    assert len(log) == len(flights)
+    t_iter, _ = best_time(lambda: sum(1 for _ in log))
+
+    print "%d flights, %.1f MB" % (len(flights), mb)
+    print "csv.reader only:         %.2f s, %.1f MB/s" % (t_csv, mb / t_csv)
+    print "Flight.generate_from_csv: %.2f s, %.1f MB/s" % (t_gen, mb / t_gen)
+    print "FlightLog.from_csv:      %.2f s, %.1f MB/s" % (t_log, mb / t_log)
+    print "FlightLog.from_file:     %.2f s, %.1f MB/s" % (t_file, mb / t_file)
+    print "Building flights from log: %.2f s" % t_iter
+
+if __name__ == '__main__':
+    main()
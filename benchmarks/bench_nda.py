@@ -0,0 +1,38 @@
+# -*- coding: utf-8
+#
+# NDA statement decoding throughput
+#
+# Usage: python -m benchmarks.bench_nda [years] [transactions per day]
+
+from benchmarks import synth
+from pik import nda
+from pik.util import Period
+import datetime as dt
+import random
+import sys
+import time
+
+def main():
+    years = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    per_day = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    rng = random.Random(1)
+    refs = [str(rng.randint(100000, 119999)) for _ in range(1000)]
+    end = dt.date(2021, 12, 31)
+    start = dt.date(end.year - years + 1, 1, 1)
+    lines = [l + "\r\n" for l in synth.nda_statement(rng, ["FI2413093000112458", "FI2613093000203505"], start, end, per_day, refs)]
+
+    period = Period(start, end)
+    best = None
+    for _ in range(3):
+        t0 = time.time()
+        n = 0
+        for txn in nda.transactions(lines):
+            # Same fields as the bank transaction filter of invoice-flights.py
+            if txn.date in period and txn.cents > 0 and txn.ref:
+                n += 1
+        elapsed = time.time() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    print "%d lines, %d matching transactions, %.2f s, %.0f lines/s" % (len(lines), n, best, len(lines) / best)
+
+if __name__ == '__main__':
+    main()
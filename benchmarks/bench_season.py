@@ -0,0 +1,168 @@
+# -*- coding: utf-8
+#
+# End-to-end billing benchmark on synthetic seasons
+#
+# Generates a season of inputs with benchmarks.synth, unless it already
+# exists, runs invoice-flights.py on it with the run report enabled, and
+# appends time of each stage to a results file. Each run is compared with
+# the previous run on the same data in the file, and stages that got slower
+# than the threshold are reported.
+#
+# Usage: python -m benchmarks.bench_season [options], see --help
+
+from benchmarks import synth
+from pik.pricetables import PriceTables
+import argparse
+import datetime as dt
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+INVOICE_FLIGHTS = os.path.join(ROOT, "invoice-flights.py")
+
+def dataset_name(args):
+    return "season-%df-%dm-%dy-%d" % (args.flights, args.members, args.years, args.seed)
+
+def add_dataset_arguments(parser):
+    parser.add_argument("--flights", type=int, default=10000, help="Number of flights, 1k to 1M")
+    parser.add_argument("--members", type=int, default=500, help="Number of members, 100 to 50k")
+    parser.add_argument("--years", type=int, default=1, help="Number of seasons, ending with --last-year")
+    parser.add_argument("--last-year", type=int, default=2021)
+    parser.add_argument("--flight-files", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--data-dir", help="Directory of generated datasets, default is under the temporary directory")
+
+def make_dataset(args):
+    """
+    Generate dataset given by args, unless it exists, and return the name of its conf file
+    """
+    data_dir = os.path.join(args.data_dir or os.path.join(tempfile.gettempdir(), "pik-bench"), dataset_name(args))
+    if os.path.exists(os.path.join(data_dir, "conf.json")):
+        return os.path.join(data_dir, "conf.json")
+    print >> sys.stderr, "Generating", data_dir
+    rng = random.Random(args.seed)
+    end = dt.date(args.last_year, 12, 31)
+    start = dt.date(args.last_year - args.years + 1, 1, 1)
+    aircraft = synth.aircraft_codes(PriceTables.load(os.path.join(ROOT, "price-tables.json")), range(start.year, end.year + 1))
+    return synth.write_season(data_dir, rng, aircraft, start, end, args.flights, args.members, args.flight_files)
+
+def run_once(conf_fname, extra_conf, script=INVOICE_FLIGHTS):
+    """
+    Run invoice-flights.py with given conf, and return its run report, or
+    None if the script doesn't write one
+
+    Outputs of a previous run with the same conf are removed first.
+
+    :param extra_conf: Dict of conf keys that override those in the conf file
+    :param script: invoice-flights.py to run, e.g. of another checkout
+    """
+    with open(conf_fname, "rb") as f:
+        conf = json.load(f)
+    conf.update(extra_conf)
+    conf["run_report"] = True
+    report_fname = os.path.normpath(conf["out_dir"]) + "-report.json"
+    for fname in (conf["out_dir"], conf["context_file_out"], report_fname):
+        if os.path.isdir(fname):
+            shutil.rmtree(fname)
+        elif os.path.exists(fname):
+            os.remove(fname)
+    fd, run_conf_fname = tempfile.mkstemp(suffix=".json")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            json.dump(conf, f)
+        with open(os.devnull, "wb") as devnull:
+            subprocess.check_call([sys.executable, script, run_conf_fname, "bench"],
+                                  stdout=devnull, stderr=devnull)
+    finally:
+        os.remove(run_conf_fname)
+    if not os.path.exists(report_fname):
+        return None
+    with open(report_fname, "rb") as f:
+        return json.load(f)
+
+def best_of(reports):
+    """
+    Return best wall time of each stage and the whole run in given run reports
+    """
+    result = {'total': min(report['wall_seconds'] for report in reports),
+              'peak_rss_kb': min(report['peak_rss_kb'] for report in reports)}
+    for report in reports:
+        for stage in report['stages']:
+            name = stage['name']
+            result[name] = min(result.get(name, stage['wall_seconds']), stage['wall_seconds'])
+    return result
+
+def git_revision():
+    try:
+        with open(os.devnull, "wb") as devnull:
+            return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(previous, current, threshold):
+    """
+    Return lines comparing stage times of given results, and whether any
+    stage got slower than threshold, as a fraction
+    """
+    lines = ["%-20s %10s %10s %8s" % ("Stage", "Previous", "Current", "Change")]
+    regression = False
+    for name in sorted(current['times'], key=lambda name: (name == 'total', name)):
+        if name == 'peak_rss_kb':
+            continue
+        now = current['times'][name]
+        before = previous['times'].get(name)
+        if before is None:
+            lines.append("%-20s %10s %10.3f" % (name, "", now))
+            continue
+        change = (now - before) / before if before > 0 else 0.0
+        # Ignore noise in stages too short to time reliably
+        slower = change > threshold and now - before > 0.05
+        regression = regression or slower
+        lines.append("%-20s %10.3f %10.3f %+7.1f%%%s" % (name, before, now, 100 * change, "  slower" if slower else ""))
+    return lines, regression
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end billing benchmark on synthetic seasons")
+    add_dataset_arguments(parser)
+    parser.add_argument("--conf", default="{}", help="JSON object of conf keys added to the generated conf")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of runs, best time of each stage is recorded")
+    parser.add_argument("--label", default="", help="Label of the results, e.g. name of the change")
+    parser.add_argument("--results", default=os.path.join(ROOT, "bench-results.json"), help="Results file")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Report stages that got slower by more than this fraction")
+    args = parser.parse_args()
+
+    conf_fname = make_dataset(args)
+    extra_conf = json.loads(args.conf)
+    reports = [run_once(conf_fname, extra_conf) for _ in range(args.repeat)]
+
+    current = {'dataset': dataset_name(args), 'conf': extra_conf, 'label': args.label, 'revision': git_revision(),
+               'date': dt.datetime.now().isoformat(), 'times': best_of(reports),
+               'counters': reports[-1]['counters']}
+    results = []
+    if os.path.exists(args.results):
+        with open(args.results, "rb") as f:
+            results = json.load(f)
+    previous = [r for r in results if r['dataset'] == current['dataset'] and r['conf'] == current['conf']]
+    results.append(current)
+    with open(args.results, "wb") as f:
+        json.dump(results, f, indent=1, sort_keys=True)
+
+    print "%s, best of %d runs, peak RSS %d kB" % (current['dataset'], args.repeat, current['times']['peak_rss_kb'])
+    if previous:
+        lines, regression = compare(previous[-1], current, args.threshold)
+        print "Compared with %s %s" % (previous[-1]['revision'], previous[-1]['label'])
+        print "\n".join(lines)
+        if regression:
+            sys.exit(2)
+    else:
+        for name in sorted(current['times']):
+            if name != 'peak_rss_kb':
+                print "%-20s %10.3f" % (name, current['times'][name])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+# -*- coding: utf-8
+#
+# Golden-output equivalence of two billing runs
+#
+# Runs invoice-flights.py twice on the same inputs, e.g. with and without a
+# fast path enabled in conf, or the scripts of two checkouts, and compares
+# all outputs: invoice files, totals.csv, rows_YYYY.csv, the Hansa export
+# and the context file. The first difference of each output is reported
+# with its account and line. With --verify-codegen, generated rule code is
+# checked against the rule tree for every event, and a run fails on the
+# first difference.
+#
+# Usage: python -m benchmarks.equivalence --conf-b '{"vectorized_caps": true}' [options], see --help
+
+from benchmarks import bench_season
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+# Conf keys of output files, which are set for each run
+OUTPUT_CONF_KEYS = ["out_dir", "context_file_out", "total_csv_name", "row_csv_name_template", "incremental_state"]
+
+class Difference(object):
+    def __init__(self, fname, line_number, account_id, line_a, line_b):
+        self.fname = fname
+        self.line_number = line_number
+        self.account_id = account_id
+        self.line_a = line_a
+        self.line_b = line_b
+
+    def __unicode__(self):
+        return u"%s, line %s, account %s:\n  a: %s\n  b: %s" % (self.fname, self.line_number, self.account_id,
+                                                                  self._show(self.line_a), self._show(self.line_b))
+
+    @staticmethod
+    def _show(line):
+        if line is None:
+            return u"(missing)"
+        return line.rstrip("\r\n").decode("utf-8", "replace")
+
+def _account_of_line(fname, line):
+    """
+    Return account id of given line of given output file, or None
+    """
+    if fname.startswith("hansa-export"):
+        fields = line.split("\t")
+        return fields[5] if len(fields) > 5 else None
+    if fname.endswith(".csv"):
+        fields = line.split(",")
+        return fields[1] if len(fields) > 1 else None
+    if fname.endswith(".txt"):
+        return fname[:-len(".txt")]
+    return None
+
+def compare_files(fname, path_a, path_b):
+    """
+    Return first Difference of given text files, or None if they're equal
+    """
+    with open(path_a, "rb") as a, open(path_b, "rb") as b:
+        line_number = 0
+        while True:
+            line_a, line_b = a.readline(), b.readline()
+            line_number += 1
+            if line_a != line_b:
+                return Difference(fname, line_number, _account_of_line(fname, line_a or line_b),
+                                  line_a or None, line_b or None)
+            if not line_a:
+                return None
+
+def compare_contexts(path_a, path_b):
+    """
+    Return first Difference of given context files by account, or None if they're equal
+    """
+    with open(path_a, "rb") as f:
+        ctx_a = json.load(f)
+    with open(path_b, "rb") as f:
+        ctx_b = json.load(f)
+    for account_id in sorted(set(ctx_a) | set(ctx_b)):
+        values_a, values_b = ctx_a.get(account_id, {}), ctx_b.get(account_id, {})
+        for variable in sorted(set(values_a) | set(values_b)):
+            if values_a.get(variable) != values_b.get(variable):
+                show = lambda values: None if variable not in values else "%s = %r" % (variable, values[variable])
+                return Difference("context", variable, account_id, show(values_a), show(values_b))
+    return None
+
+def _output_order(fname):
+    # Invoices first, in account order, then the shared files
+    return (not fname.endswith(".txt") or fname.startswith("hansa-export"), fname)
+
+def compare_outputs(out_a, ctx_a, out_b, ctx_b):
+    """
+    Return list of first Differences of each output of two runs
+    """
+    differences = []
+    fnames = set(os.listdir(out_a)) | set(os.listdir(out_b))
+    for fname in sorted(fnames, key=_output_order):
+        path_a, path_b = os.path.join(out_a, fname), os.path.join(out_b, fname)
+        exists_a, exists_b = os.path.exists(path_a), os.path.exists(path_b)
+        if not (exists_a and exists_b):
+            differences.append(Difference(fname, None, _account_of_line(fname, ""),
+                                          "(file)" if exists_a else None, "(file)" if exists_b else None))
+            continue
+        difference = compare_files(fname, path_a, path_b)
+        if difference is not None:
+            differences.append(difference)
+    difference = compare_contexts(ctx_a, ctx_b)
+    if difference is not None:
+        differences.append(difference)
+    return differences
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare outputs of two billing runs on the same inputs")
+    bench_season.add_dataset_arguments(parser)
+    parser.add_argument("--input-conf", help="Conf file of the inputs, instead of a generated dataset")
+    parser.add_argument("--conf-a", default="{}", help="JSON object of conf keys of run a")
+    parser.add_argument("--conf-b", default="{}", help="JSON object of conf keys of run b")
+    parser.add_argument("--script-a", default=bench_season.INVOICE_FLIGHTS, help="invoice-flights.py of run a")
+    parser.add_argument("--script-b", default=bench_season.INVOICE_FLIGHTS, help="invoice-flights.py of run b")
+    parser.add_argument("--work-dir", help="Directory of the outputs, default is next to the input conf")
+    parser.add_argument("--limit", type=int, default=10, help="Number of differing outputs to show")
+    parser.add_argument("--verify-codegen", action="store_true",
+                        help="Check generated rule code against the rule tree for every event in both runs")
+    args = parser.parse_args()
+
+    conf_fname = args.input_conf or bench_season.make_dataset(args)
+    work_dir = args.work_dir or os.path.join(os.path.dirname(os.path.abspath(conf_fname)), "equivalence")
+    if not os.path.exists(work_dir):
+        os.makedirs(work_dir)
+    # Outputs of the input conf are replaced by those of each run
+    with open(conf_fname, "rb") as f:
+        conf = json.load(f)
+    for key in OUTPUT_CONF_KEYS:
+        conf.pop(key, None)
+    base_fname = os.path.join(work_dir, "base-conf.json")
+    with open(base_fname, "wb") as f:
+        json.dump(conf, f, indent=1, sort_keys=True)
+
+    runs = []
+    for name, side_conf, script in (("a", args.conf_a, args.script_a), ("b", args.conf_b, args.script_b)):
+        run_conf = json.loads(side_conf)
+        if args.verify_codegen:
+            run_conf["rule_codegen_verify"] = None
+        run_conf["out_dir"] = os.path.join(work_dir, name)
+        run_conf["context_file_out"] = os.path.join(work_dir, name + "-ctx.json")
+        if "incremental_state" in run_conf and os.path.exists(run_conf["incremental_state"]):
+            os.remove(run_conf["incremental_state"])
+        print >> sys.stderr, "Running", name, script, side_conf
+        try:
+            report = bench_season.run_once(base_fname, run_conf, script)
+        except subprocess.CalledProcessError:
+            print "Run %s failed, e.g. because generated rules differ from the rule tree" % name
+            print "Conf keys of the run, added to %s: %s" % (base_fname, json.dumps(run_conf))
+            sys.exit(1)
+        if report is not None:
+            print >> sys.stderr, "  %.3f s" % report['wall_seconds']
+        runs.append(run_conf)
+
+    differences = compare_outputs(runs[0]["out_dir"], runs[0]["context_file_out"],
+                                  runs[1]["out_dir"], runs[1]["context_file_out"])
+    if not differences:
+        print "Outputs are equal, %d files and the context" % len(os.listdir(runs[0]["out_dir"]))
+        return
+    print "%d outputs differ, first difference of each:" % len(differences)
+    for difference in differences[:args.limit]:
+        print unicode(difference).encode("utf-8")
+    sys.exit(1)
+
+if __name__ == '__main__':
+    main()
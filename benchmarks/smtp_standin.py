@@ -0,0 +1,107 @@
+# -*- coding: utf-8
+#
+# Local SMTP stand-in for testing send.py
+#
+# An smtpd server that accepts messages without delivering them, and
+# misbehaves like a mail provider: it refuses a share of recipients with a
+# 451 throttle reply, and drops connections after a number of messages.
+# Received messages are counted by recipient and printed on exit, and
+# optionally written into a directory.
+#
+# Usage: python -m benchmarks.smtp_standin [options], see --help, and set
+# "smtps_host": "localhost:8025", "smtp_ssl": false in the conf of send.py,
+# without "smtp_user".
+
+from collections import Counter
+import argparse
+import asyncore
+import os
+import random
+import smtpd
+import sys
+
+class StandinChannel(smtpd.SMTPChannel):
+    # smtpd.SMTPChannel keeps its server and state in private attributes
+    server = property(lambda self: self._SMTPChannel__server)
+    state = property(lambda self: self._SMTPChannel__state)
+
+    def __init__(self, server, conn, addr):
+        smtpd.SMTPChannel.__init__(self, server, conn, addr)
+        self.messages = 0
+
+    def smtp_RCPT(self, arg):
+        if self.server.rng.random() < self.server.throttle:
+            self.server.throttled += 1
+            self.push("451 4.7.1 Throttled, try again later")
+            return
+        smtpd.SMTPChannel.smtp_RCPT(self, arg)
+
+    def found_terminator(self):
+        in_data = self.state == self.DATA
+        smtpd.SMTPChannel.found_terminator(self)
+        if in_data and self.state == self.COMMAND:
+            self.messages += 1
+            if self.server.drop_after and self.messages >= self.server.drop_after:
+                # Reply to the message is sent before the connection is closed
+                self.server.dropped += 1
+                self.close_when_done()
+
+class StandinServer(smtpd.SMTPServer):
+    """
+    :param throttle: Share of recipients refused with 451
+    :param drop_after: Number of messages after which a connection is closed, or None
+    :param out_dir: Directory to write messages into, or None
+    """
+    def __init__(self, localaddr, throttle=0.0, drop_after=None, out_dir=None, seed=1):
+        smtpd.SMTPServer.__init__(self, localaddr, None)
+        self.throttle = throttle
+        self.drop_after = drop_after
+        self.out_dir = out_dir
+        self.rng = random.Random(seed)
+        self.received = Counter()
+        self.throttled = 0
+        self.dropped = 0
+        self.connections = 0
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            conn, addr = pair
+            self.connections += 1
+            StandinChannel(self, conn, addr)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        for rcpt in rcpttos:
+            self.received[rcpt] += 1
+        if self.out_dir:
+            fname = os.path.join(self.out_dir, "%06d.eml" % sum(self.received.values()))
+            with open(fname, "wb") as f:
+                f.write(data)
+        return None
+
+    def summary(self):
+        return ("%d messages to %d recipients over %d connections, %d throttled, %d connections dropped, %d duplicates"
+                % (sum(self.received.values()), len(self.received), self.connections, self.throttled, self.dropped,
+                   sum(n - 1 for n in self.received.values())))
+
+def main():
+    parser = argparse.ArgumentParser(description="Local SMTP stand-in that throttles and drops connections")
+    parser.add_argument("--port", type=int, default=8025)
+    parser.add_argument("--throttle", type=float, default=0.1, help="Share of recipients refused with 451")
+    parser.add_argument("--drop-after", type=int, help="Close connections after this many messages")
+    parser.add_argument("--out-dir", help="Directory to write received messages into")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    if args.out_dir and not os.path.exists(args.out_dir):
+        os.makedirs(args.out_dir)
+    server = StandinServer(("localhost", args.port), args.throttle, args.drop_after, args.out_dir, args.seed)
+    print >> sys.stderr, "Listening on localhost:%d" % args.port
+    try:
+        asyncore.loop()
+    except KeyboardInterrupt:
+        pass
+    print server.summary()
+
+if __name__ == '__main__':
+    main()
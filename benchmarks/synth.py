@@ -0,0 +1,234 @@
+# -*- coding: utf-8
+#
+# Synthetic input data for benchmarks
+#
+# write_season() writes a whole season of inputs for invoice-flights.py:
+# flight logs with every aircraft of the price tables, simple events with
+# package purchases and rollup balances, and a bank statement of member
+# payments, together with a conf file.
+
+from pik.flights import ALLOWED_PURPOSES
+import csv
+import datetime as dt
+import json
+import os
+
+def _yymmdd(date):
+    return date.strftime("%y%m%d")
+
+def _count(rng, per_day):
+    """
+    Random number of items for a day, per_day on average, which may be a fraction
+    """
+    return int(2 * per_day * rng.random() + 0.5)
+
+def nda_header(iban, bic="NDEAFIHH"):
+    """
+    T00 record, with account number in the position read by pik.nda.Record00
+    """
+    return "T00322" + " " * 286 + iban + " " + bic
+
+def nda_transaction(seq, date, cents, ref="", name="MAKSAJA OY", operation="Viitesiirto", receipt=" ", is_receipt=" "):
+    """
+    T10 record, with fields in the positions read by pik.nda.Record10
+    """
+    d = _yymmdd(date)
+    return "T10188%06d%-18s%s%s%s%-4s%-35s%s%018d%s %-35s%-16s%-20s%-8s%s%-10s" % (
+        seq, "ARCHIVE%011d" % seq, d, d, d, "710", operation[:35],
+        "+" if cents >= 0 else "-", abs(cents), receipt, name[:35], "", ref, "", is_receipt, "")
+
+def nda_message(msg):
+    return "T11080" + "00" + msg
+
+def nda_reference(ref):
+    return "T11080" + "06" + "%035d" % int(ref)
+
+def nda_statement(rng, ibans, start, end, txns_per_day, refs):
+    """
+    Generate lines of an NDA statement with one section per account
+
+    Roughly one in twenty transactions is a card payment followed by its
+    receipt transactions. Receipt groups are always followed by a plain
+    transaction, as in statements from the bank.
+
+    :param rng: random.Random instance
+    :param ibans: Account numbers
+    :param start: First ledger date
+    :param end: Last ledger date
+    :param txns_per_day: Average number of transactions per account per day
+    :param refs: Reference numbers for incoming payments
+    """
+    seq = 0
+    for iban in ibans:
+        yield nda_header(iban)
+        date = start
+        while date <= end:
+            for _ in range(_count(rng, txns_per_day)):
+                seq += 1
+                if rng.random() < 0.05:
+                    yield nda_transaction(seq, date, -rng.randint(100, 99999), operation="Korttiosto", receipt="E")
+                    for _ in range(rng.randint(1, 3)):
+                        seq += 1
+                        yield nda_transaction(seq, date, -rng.randint(1, 999), operation="Korttiosto", is_receipt="1")
+                    seq += 1
+                if rng.random() < 0.7:
+                    yield nda_transaction(seq, date, rng.randint(100, 90000), ref=rng.choice(refs))
+                else:
+                    yield nda_transaction(seq, date, -rng.randint(100, 90000), operation="Itsepalvelu")
+                    if rng.random() < 0.5:
+                        yield nda_message("Lasku %d {kes[" % seq)
+            date += dt.timedelta(1)
+        yield "T40"
+
+FLIGHT_LOG_HEADER = ["Lentokone", "Tapahtumapäivä", "Maksajan viitenumero", "Päällikön viitenumero", "Oppilaan viitenumero",
+                     "Henkilöluku", "Lähtöpaikka", "Laskeutumispaikka", "Lähtöaika", "Laskeutumisaika", "Lentoaika", "Laskuja",
+                     "Tarkoitus", "Lentoaika_desimaalinen", "Laskutuslisä, syy", "Lisätiedot", "Siirtohinaus"]
+
+def flight_log(rng, aircraft, start, end, flights_per_day, account_ids):
+    """
+    Generate rows of a flight log in date order, with a header row, in the
+    format read by pik.flights.Flight.generate_from_csv
+
+    Purposes are all of pik.flights.ALLOWED_PURPOSES, and some in lower
+    case. Some flights have an invoicing comment, and some are transfer tows.
+
+    :param rng: random.Random instance
+    :param aircraft: Aircraft registrations or competition ids
+    :param start: First flight date
+    :param end: Last flight date
+    :param flights_per_day: Average number of flights per day
+    :param account_ids: Payer account ids
+    """
+    purposes = sorted(ALLOWED_PURPOSES) + ["kou"]
+    yield FLIGHT_LOG_HEADER
+    date = start
+    while date <= end:
+        for _ in range(_count(rng, flights_per_day)):
+            takeoff = rng.randint(8 * 60, 20 * 60)
+            duration = rng.randint(3, 300)
+            landing = takeoff + duration
+            row = [rng.choice(aircraft), date.isoformat(), rng.choice(account_ids), "Päällikkö", "", "1",
+                   rng.choice(["efhf", "EFNU", "efjm"]), "efhf",
+                   "%d:%02d" % divmod(takeoff, 60), "%d:%02d" % divmod(landing % (24 * 60), 60), "%d:%02d" % divmod(duration, 60),
+                   "1", rng.choice(purposes), str(duration), rng.choice(["", "", "", "ei viitettä"]), ""]
+            if rng.random() < 0.5:
+                row.append("1" if rng.random() < 0.05 else "")
+            yield row
+        date += dt.timedelta(1)
+
+def aircraft_codes(price_tables, years=None):
+    """
+    Return sorted aircraft with flight prices in seasons of given
+    pik.pricetables.PriceTables
+
+    :param years: Years of the seasons, or None for all seasons
+    """
+    codes = set()
+    def add(aircraft):
+        codes.update([aircraft] if isinstance(aircraft, basestring) else aircraft)
+    for season in price_tables.seasons:
+        if years is not None and season["year"] not in years:
+            continue
+        for flight in season.get("flights", []):
+            add(flight["aircraft"])
+        for glider in season.get("gliders", {}).get("prices", []):
+            add(glider["aircraft"])
+    return sorted(str(code) for code in codes)
+
+EVENT_HEADER = ["Tapahtumapäivä", "Maksajan viitenumero", "Selite", "Summa", "Nimi", "Kirjaus", "Alkuperäinen vuosi", "Tili"]
+
+def simple_events(rng, start, end, account_ids, events_per_member=4, rollup_date=None):
+    """
+    Generate rows of a simple event file, with a header row, in the format
+    read by pik.event.SimpleEvent.generate_from_csv
+
+    Each year a fifth of the members buy a pursikönttä and a tenth a
+    kurssikönttä early in the season. Other events are charges and refunds
+    on random dates, some of them ledgered by hand.
+
+    :param rng: random.Random instance
+    :param start: First event date
+    :param end: Last event date
+    :param account_ids: Member account ids
+    :param events_per_member: Average number of other events per member per year
+    :param rollup_date: Date of rollup balances of all members, at the start of the file, or None
+    """
+    yield EVENT_HEADER
+    if rollup_date is not None:
+        for account_id in account_ids:
+            yield [rollup_date.isoformat(), account_id, "Lentotilin saldo %s" % rollup_date.isoformat(),
+                   "%.2f" % (rng.randint(-20000, 50000) / 100.0)]
+    for year in range(start.year, end.year + 1):
+        first = max(start, dt.date(year, 1, 1))
+        last = min(end, dt.date(year, 12, 31))
+        days = (last - first).days
+        for item, share, price, account in (("Pursikönttä", 0.2, "950", "3220"), ("Kurssikönttä", 0.1, "1200", "3470")):
+            for account_id in rng.sample(account_ids, int(len(account_ids) * share)):
+                date = first + dt.timedelta(rng.randint(0, min(days, 150)))
+                yield [date.isoformat(), account_id, "%s %d" % (item, year), price, "", str(year), str(year), account]
+        for _ in range(int(len(account_ids) * events_per_member * (days + 1) / 365.0)):
+            date = first + dt.timedelta(rng.randint(0, days))
+            cents = rng.choice([rng.randint(100, 20000), -rng.randint(100, 5000)])
+            entry = "käsin" if rng.random() < 0.1 else str(year)
+            yield [date.isoformat(), rng.choice(account_ids), rng.choice(["Jäsenmaksu %d" % year, "Hyvitys", "Kerhon myymälä"]),
+                   "%.2f" % (cents / 100.0), "", entry, str(year), "3000"]
+
+CLUB_IBANS = ["FI2413093000112458", "FI2613093000203505"]
+
+def _write_rows(fname, rows):
+    with open(fname, "wb") as f:
+        csv.writer(f).writerows(rows)
+
+def write_season(out_dir, rng, aircraft, start, end, flights, members, flight_files=1):
+    """
+    Write inputs of invoice-flights.py for given period into out_dir, and
+    return the name of the conf file
+
+    The conf writes outputs to out_dir/out.
+
+    :param rng: random.Random instance
+    :param aircraft: Aircraft codes, see aircraft_codes()
+    :param flights: Total number of flights, on average
+    :param members: Number of members
+    :param flight_files: Number of flight logs, flights are split evenly between them
+    """
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    days = (end - start).days + 1
+    account_ids = [str(account_id) for account_id in rng.sample(xrange(100000, 1000000), members)]
+    with open(os.path.join(out_dir, "ids.txt"), "wb") as f:
+        f.write("\n".join(account_ids) + "\n")
+
+    flight_fnames = []
+    for i in range(flight_files):
+        fname = os.path.join(out_dir, "flights%d.csv" % i)
+        _write_rows(fname, flight_log(rng, aircraft, start, end, flights / float(days * flight_files), account_ids + ["PIK1"]))
+        flight_fnames.append(fname)
+
+    event_fname = os.path.join(out_dir, "events.csv")
+    _write_rows(event_fname, simple_events(rng, start, end, account_ids, rollup_date=start - dt.timedelta(1)))
+
+    nda_fname = os.path.join(out_dir, "bank.nda")
+    with open(nda_fname, "wb") as f:
+        for line in nda_statement(rng, CLUB_IBANS, start, end, members / 100.0, account_ids):
+            f.write(line + "\r\n")
+
+    conf = {"event_files": [event_fname],
+            "flight_files": flight_fnames,
+            "nda_files": [nda_fname],
+            "bank_txn_dates": [start.isoformat(), end.isoformat()],
+            "valid_id_files": [os.path.join(out_dir, "ids.txt")],
+            "no_invoicing_prefix": ["PIK", "MIK", "FLK", "RS", "EFNU"],
+            "invoice_date": end.isoformat(),
+            "description": "Lentolaskut %s - %s" % (start.isoformat(), end.isoformat()),
+            "hansa_txn_dates": [start.isoformat(), end.isoformat()],
+            "hansa_first_txn_id": 1000,
+            "hansa_year": end.year,
+            "hansa_entry_date": end.strftime("%d.%m.%Y"),
+            "hansa_txn_date": end.strftime("%d.%m.%Y"),
+            "out_dir": os.path.join(out_dir, "out"),
+            "context_file_out": os.path.join(out_dir, "out-ctx.json")}
+    conf_fname = os.path.join(out_dir, "conf.json")
+    with open(conf_fname, "wb") as f:
+        json.dump(conf, f, indent=1, sort_keys=True)
+    return conf_fname
@@ -5,10 +5,11 @@ import sys
 import csv
 from itertools import izip, repeat, count
 import datetime as dt
-import unicodedata
 from collections import defaultdict
 
 from hansa import SimpleHansaTransaction, SimpleHansaRow
+from export import BACKENDS, HansaBackend
+from money import to_cents
 import argparse
 
 def mapping_reader(names, row_reader):
@@ -49,17 +50,17 @@ HANSA_ACCOUNTS = {1601:u"Käteiskassa",
 
 
 TITLE_BY_ACCOUNT = {
-    5101: lambda event: (u"Jäsenmaksu / " if _txn_sum(event) == 25 else (u"Ainaisjäsenmaksu / " if _txn_sum(event) == 250 else u"Jäsenmaksuja / "))  + (event[u"Viite"] or event[u"Saaja/Maksaja"]),
+    5101: lambda event: (u"Jäsenmaksu / " if _txn_cents(event) == 2500 else (u"Ainaisjäsenmaksu / " if _txn_cents(event) == 25000 else u"Jäsenmaksuja / "))  + (event[u"Viite"] or event[u"Saaja/Maksaja"]),
     5103: lambda event: u"Lahjoitus / " + event.get(u"Viesti", u"Ei viestiä"),
     1601: lambda event: u"Käteistilitys / " + event.get(u"Viesti", u"Ei viestiä"),
     1422: lambda event: u"Lentotilimaksu / " + event[u"Viite"],
     }
 
 VALIDATOR_BY_ACCOUNT = {
-    5101: lambda event: _txn_sum(event) == 25 or _txn_sum(event) == 250 or 'ILMAILULIITTO' in event['Saaja/Maksaja'],
-    5103: lambda event: _txn_sum(event) > 0,
-    1601: lambda event: _txn_sum(event) > 0,
-    1422: lambda event: _txn_sum(event) > 0,
+    5101: lambda event: _txn_cents(event) == 2500 or _txn_cents(event) == 25000 or 'ILMAILULIITTO' in event['Saaja/Maksaja'],
+    5103: lambda event: _txn_cents(event) > 0,
+    1601: lambda event: _txn_cents(event) > 0,
+    1422: lambda event: _txn_cents(event) > 0,
     }
 
 class _NoTransaction(object):
@@ -67,15 +68,15 @@ class _NoTransaction(object):
 
 NoTransaction = _NoTransaction()
 
-def _txn_sum(event):
-    return float(event[u"Määrä"].replace(",","."))
+def _txn_cents(event):
+    return to_cents(event[u"Määrä"].replace(",","."))
 
 def to_txn(txn_id_gen, account, event):
     if event[u'Vienti']:
         # Already in Hansa, let's not do duplicates
         return None
     
-    txn_sum = _txn_sum(event)
+    txn_sum = _txn_cents(event)
 
     hansa_bank = BANK_ACCOUNTS[account]
     year = int(event[u"Kirjauspäivä"].split('.')[-1])
@@ -130,8 +131,11 @@ def to_txn(txn_id_gen, account, event):
     else:
         return NoTransaction
 
-def main(start_txn, csv_fnames):
+def main(start_txn, csv_fnames, format="hansa"):
     txn_id_gen = count(start_txn)
+    backend_class = BACKENDS[format]
+    # Hansa imports of bank transactions have been Latin-1
+    backend = backend_class(sys.stdout, encoding="iso-8859-1" if backend_class is HansaBackend else None)
     unprocessed_count = defaultdict(lambda:0)
     for event in gen_events(csv_fnames):
         try:
@@ -146,19 +150,17 @@ def main(start_txn, csv_fnames):
             continue
 
         if txn is not None:
-            sys.stdout.write(unicodedata.normalize("NFC", txn.hansaformat()).encode("iso-8859-1"))
-    
+            backend.write(txn)
+    backend.close()
+
     for act in sorted(unprocessed_count.keys()):
         print >> sys.stderr, act, unprocessed_count[act]
 
 if __name__ == '__main__':
-    if len(sys.argv) < 3:
-        print >> sys.stderr, "Usage: csv2hansa.py start_number <csv file>..."
-        print >> sys.stderr, "  Reads transactions from annotated Nordea text files, produces Hansa row imports"
-        print >> sys.stderr, "  Hansa transactions will start from a number specified on command line. "
-        print >> sys.stderr, "  Hansa acco"
-        sys.exit(1)
-
-    start_txn = int(sys.argv[1])
-    csv_fnames = sys.argv[2:]
-    main(start_txn, csv_fnames)
+    parser = argparse.ArgumentParser(description="Reads transactions from annotated Nordea text files, produces Hansa row imports. "
+                                     "Hansa transactions will start from a number specified on command line.")
+    parser.add_argument("--format", choices=sorted(BACKENDS), default="hansa", help="Export format, default hansa")
+    parser.add_argument("start_number", type=int)
+    parser.add_argument("csv_files", nargs="+")
+    args = parser.parse_args()
+    main(args.start_number, args.csv_files, args.format)
@@ -2,6 +2,8 @@
 import collections
 import datetime as dt
 from pik.util import parse_iso8601_date
+from pik.money import Cents, to_cents, to_decimal
+from pik.registry import RULES, EVENTS
 import decimal
 
 class Invoice(object):
@@ -11,8 +13,10 @@ class Invoice(object):
         self.lines = lines
 
     def total(self):
-        with decimal.localcontext() as ctx:
-            return sum(l.price for l in self.lines).quantize(decimal.Decimal('.01'))
+        return to_decimal(self.total_cents())
+
+    def total_cents(self):
+        return sum(l.cents for l in self.lines)
 
     def to_json(self):
         return {'account_id' : self.account_id,
@@ -49,17 +53,34 @@ class Invoice(object):
 
 class InvoiceLine(object):
     CsvRow = collections.namedtuple('InvoiceLineCsvRow', ['date', 'account_id', 'item', 'price', 'ledger_year'])
-    def __init__(self, account_id, date, item, price, rule, event, ledger_account_id, ledger_year=None, rollup=False):
+    __slots__ = ('account_id', 'date', 'item', 'cents', 'rule_id', 'event_id', 'ledger_account_id', 'ledger_year', 'rollup')
+
+    def __init__(self, account_id, date, item, cents, rule, event, ledger_account_id, ledger_year=None, rollup=False):
         self.account_id = account_id # Account for which this line was generated
         self.date = date
         self.item = item
-        self.price = price if isinstance(price, decimal.Decimal) else decimal.Decimal(price).quantize(decimal.Decimal('.01'))
-        self.rule = rule # Rule that generated this invoice line
-        self.event = event # Event that generated this invoice line
+        self.cents = cents # Price in integer cents
+        self.rule_id = RULES.id_of(rule) # Rule that generated this invoice line
+        self.event_id = EVENTS.id_of(event) # Event that generated this invoice line
         self.ledger_account_id = ledger_account_id # Ledger account for this event, e.g. "income from past years"
         self.ledger_year = ledger_year # Ledger year for this event
         self.rollup = rollup
 
+    @property
+    def price(self):
+        return to_decimal(self.cents)
+
+    @property
+    def rule(self):
+        return RULES.get(self.rule_id)
+
+    @property
+    def event(self):
+        """
+        Event that generated this line, or None if the event has been freed
+        """
+        return EVENTS.get(self.event_id)
+
     def __str__(self):
         return "%s: %f <- %s" %(self.account_id, self.price, self.item)
 
@@ -94,7 +115,7 @@ class InvoiceLine(object):
         return InvoiceLine(json_dict['account_id'],
                            parse_iso8601_date(json_dict['date']),
                            json_dict['item'],
-                           json_dict['price'],
+                           to_cents(json_dict['price']),
                            None,
                            None)
 
@@ -102,6 +123,8 @@ class InvoiceLine(object):
 class BillingContext(object):
     """
     Provides numeric and string variables for accounts
+
+    Money is stored as Cents, and as decimal euros in JSON.
     """
     def __init__(self):
         self.account_contexts = collections.defaultdict(lambda: 0)
@@ -116,6 +139,8 @@ class BillingContext(object):
         result = collections.defaultdict(lambda: {})
         for k, v in self.account_contexts.items():
             account_id, variable_id = k
+            if isinstance(v, Cents):
+                v = to_decimal(v)
             result[account_id][variable_id] = v
         return result
 
@@ -124,5 +149,7 @@ class BillingContext(object):
         result = BillingContext()
         for account_id, account_vars in json_dict.items():
             for var_name, value in account_vars.items():
+                if isinstance(value, (float, decimal.Decimal)):
+                    value = Cents(to_cents(value))
                 result.set(account_id, var_name, value)
         return result
@@ -0,0 +1,108 @@
+# -*- coding: utf-8
+#
+# On-disk cache of parsed input files
+#
+# Parsed events are stored as batches of pickles, in a file named by the
+# hash of the parser id and the input file content. Least recently used
+# entries are evicted when the cache grows over its size limit.
+
+import cPickle as pickle
+import hashlib
+import os
+import tempfile
+
+BATCH_SIZE = 1000
+
+def file_digest(fname):
+    h = hashlib.sha1()
+    with open(fname, "rb") as f:
+        while True:
+            data = f.read(1 << 20)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+class ParseCache(object):
+    def __init__(self, cache_dir, max_bytes=256 << 20):
+        """
+        :param cache_dir: Directory for cache files, created if it doesn't exist
+        :param max_bytes: Size limit for the cache
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def path(self, fname, parser_id):
+        h = hashlib.sha1(parser_id)
+        h.update(file_digest(fname))
+        return os.path.join(self.cache_dir, h.hexdigest() + ".pickle")
+
+    def load(self, fname, parser_id, parse):
+        """
+        Generate parsed items of given file, from cache if the file has been
+        parsed before with the same parser
+
+        :param fname: Input file name
+        :param parser_id: Parser name and version, change when parser output changes
+        :param parse: Function that parses the named file and returns its items
+        """
+        path = self.path(fname, parser_id)
+        if os.path.exists(path):
+            # Mark as recently used
+            os.utime(path, None)
+            return self._read(path)
+        return self._parse_and_store(path, parse, fname)
+
+    def _read(self, path):
+        with open(path, "rb") as f:
+            while True:
+                try:
+                    batch = pickle.load(f)
+                except EOFError:
+                    break
+                for item in batch:
+                    yield item
+
+    def _parse_and_store(self, path, parse, fname):
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix=".tmp-")
+        f = os.fdopen(fd, "wb")
+        stored = False
+        try:
+            batch = []
+            for item in parse(fname):
+                batch.append(item)
+                if len(batch) >= BATCH_SIZE:
+                    pickle.dump(batch, f, pickle.HIGHEST_PROTOCOL)
+                    for item in batch:
+                        yield item
+                    batch = []
+            pickle.dump(batch, f, pickle.HIGHEST_PROTOCOL)
+            for item in batch:
+                yield item
+            f.close()
+            os.rename(tmp_path, path)
+            stored = True
+        finally:
+            if not stored:
+                f.close()
+                os.remove(tmp_path)
+        self.evict()
+
+    def evict(self):
+        """
+        Remove least recently used entries until cache is within its size limit
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".pickle"):
+                st = os.stat(os.path.join(self.cache_dir, name))
+                entries.append((st.st_mtime, st.st_size, name))
+        entries.sort()
+        total = sum(size for (_, size, _) in entries)
+        for (_, size, name) in entries:
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.cache_dir, name))
+            total -= size
@@ -0,0 +1,361 @@
+# -*- coding: utf-8
+#
+# Rule tree compiler that generates a specialised Python function
+#
+# The rule tree is turned into the source of a single invoice(event)
+# function, in which filters are inlined as comparisons against constant
+# periods and aircraft sets, integer hourly prices are folded into integer
+# arithmetic, and subtrees are skipped with the same guards as in
+# pik.dispatch. Rules and filters that the compiler doesn't know are called
+# as they are. Compiled code is cached on disk by the digest of the
+# generated source, which is determined by the rule tree.
+
+from pik.billing import InvoiceLine
+from pik.dispatch import rule_guard, IndexedAllRules, IndexedFirstRule
+from pik.event import SimpleEvent
+from pik.flights import Flight
+from pik.money import Cents, to_cents
+from pik.rules import BaseRule, AllRules, FirstRule, FlightRule, SimpleRule, CappedRule, SetDateRule, SetLedgerYearRule, SinceDateFilter, PeriodFilter, AircraftFilter, PurposeFilter, ItemFilter, NegationFilter, TransferTowFilter, InvoicingChargeFilter, PositivePriceFilter, NegativePriceFilter, flightFilter, eventFilter, walk_rules
+import hashlib
+import marshal
+import os
+import re
+import sys
+import tempfile
+
+_LITERAL_TYPES = (int, long, str, unicode, bool, type(None))
+
+class _Generator(object):
+    def __init__(self):
+        self.lines = []
+        self.constants = {}
+        self._constant_names = {}
+        self._n_temps = 0
+
+    def const(self, value):
+        try:
+            return self._constant_names[id(value)]
+        except KeyError:
+            name = "K%d" % len(self.constants)
+            self._constant_names[id(value)] = name
+            self.constants[name] = value
+            return name
+
+    def literal(self, value):
+        if type(value) in _LITERAL_TYPES:
+            return repr(value)
+        return self.const(value)
+
+    def temp(self):
+        self._n_temps += 1
+        return "t%d" % self._n_temps
+
+    def emit(self, indent, text):
+        self.lines.append("    " * indent + text)
+
+    def filter_expr(self, f):
+        cls = f.__class__
+        if cls is PeriodFilter:
+            return "%s <= date <= %s" % (self.const(f.period.start), self.const(f.period.end))
+        if cls is AircraftFilter:
+            return "ev.aircraft in %s" % self.const(frozenset(f.aircraft))
+        if cls is PurposeFilter:
+            return "ev.purpose in %s" % self.const(frozenset(f.purposes))
+        if cls is ItemFilter:
+            return "%s(ev.item)" % self.const(re.compile(f.regex).search)
+        if cls is NegationFilter:
+            return "not (%s)" % self.filter_expr(f.filter)
+        if cls is TransferTowFilter:
+            return "ev.transfer_tow"
+        if cls is InvoicingChargeFilter:
+            return "ev.invoicing_comment"
+        if cls is PositivePriceFilter:
+            return "ev.cents >= 0"
+        if cls is NegativePriceFilter:
+            return "ev.cents < 0"
+        if f is flightFilter:
+            return "is_flight"
+        if f is eventFilter:
+            return "is_event"
+        return "%s(ev)" % self.const(f)
+
+    def guard_expr(self, rule):
+        """
+        Return condition that an event must satisfy for given rule to have
+        any effect, "False" if none can, or None if nothing is known
+        """
+        clauses = rule_guard(rule)
+        conds = []
+        if all(clause.types is not None for clause in clauses):
+            types = set()
+            for clause in clauses:
+                types.update(clause.types)
+            if not types:
+                return "False"
+            if types == set([Flight]):
+                conds.append("is_flight")
+            elif types == set([SimpleEvent]):
+                conds.append("is_event")
+            else:
+                conds.append("isinstance(ev, (%s,))" % ", ".join(self.const(t) for t in sorted(types, key=lambda t: t.__name__)))
+            if types == set([Flight]) and all(clause.aircraft is not None for clause in clauses):
+                aircraft = frozenset().union(*[clause.aircraft for clause in clauses])
+                conds.append("ev.aircraft in %s" % self.const(aircraft))
+        if all(clause.periods for clause in clauses):
+            starts = [max(p.start for p in clause.periods) for clause in clauses]
+            ends = [min(p.end for p in clause.periods) for clause in clauses]
+            conds.append("%s <= date <= %s" % (self.const(min(starts)), self.const(max(ends))))
+        if not conds:
+            return None
+        return " and ".join(conds)
+
+    def guarded_rule(self, rule, out, indent):
+        if isinstance(rule, (FlightRule, SimpleRule)):
+            # Leaf rules check their filters anyway
+            return self.rule(rule, out, indent)
+        cond = self.guard_expr(rule)
+        if cond == "False":
+            return
+        if cond is None:
+            return self.rule(rule, out, indent)
+        self.emit(indent, "if %s:" % cond)
+        self.rule(rule, out, indent + 1)
+
+    def rule(self, rule, out, indent):
+        """
+        Emit code that appends lines produced by rule into list named out
+        """
+        cls = rule.__class__
+        if cls in (AllRules, IndexedAllRules):
+            for inner_rule in rule.inner_rules:
+                self.guarded_rule(inner_rule, out, indent)
+            self.emit(indent, "pass")
+        elif cls in (FirstRule, IndexedFirstRule):
+            tmp = self.temp()
+            self.emit(indent, "%s = []" % tmp)
+            for i, inner_rule in enumerate(rule.inner_rules):
+                if i > 0:
+                    self.emit(indent + i - 1, "if not %s:" % tmp)
+                self.guarded_rule(inner_rule, tmp, indent + i)
+                # Branch may be empty if its guard can never match
+                self.emit(indent + i, "pass")
+            self.emit(indent, "%s.extend(%s)" % (out, tmp))
+        elif cls is FlightRule:
+            conds = ["is_flight"] + ["(%s)" % self.filter_expr(f) for f in rule.filters]
+            price = rule.price
+            if isinstance(price, (int, long)):
+                # Same as hourly_cents(ev.duration, price)
+                cents = "(ev.duration * %d + 1) // 3" % (price * 5)
+            elif isinstance(price, float):
+                cents = "to_cents(ev.duration * %r)" % (price / 60.0)
+            else:
+                cents = "to_cents(%s(ev))" % self.const(rule.pricing)
+            line = lambda cents_expr: "%s.append(InvoiceLine(ev.account_id, ev.date, %s %% ev, %s, %s, ev, %s))" % (
+                out, self.literal(rule.template), cents_expr, self.const(rule), self.literal(rule.ledger_account_id))
+            if rule.batch_id is not None:
+                # Price set by pik.vectorized.BatchPricer
+                self.emit(indent, "if prices is not None:")
+                self.emit(indent + 1, "c = prices.get(%d)" % rule.batch_id)
+                self.emit(indent + 1, "if c is not None:")
+                self.emit(indent + 2, line("c"))
+                self.emit(indent, "elif %s:" % " and ".join(conds))
+            else:
+                self.emit(indent, "if %s:" % " and ".join(conds))
+            self.emit(indent + 1, line(cents))
+        elif cls is SimpleRule:
+            conds = ["is_event"] + ["(%s)" % self.filter_expr(f) for f in rule.filters]
+            self.emit(indent, "if %s:" % " and ".join(conds))
+            self.emit(indent + 1, "%s.append(InvoiceLine(ev.account_id, ev.date, ev.item, ev.cents, %s, ev, ev.ledger_account_id, ev.ledger_year, ev.rollup))" %
+                      (out, self.const(rule)))
+        elif cls is CappedRule and rule.deferred:
+            # Capped later by pik.vectorized.BatchCaps
+            self.rule(rule.inner_rule, out, indent)
+        elif cls is CappedRule:
+            tmp = self.temp()
+            ctx, var, cap, r = self.const(rule.context), self.literal(rule.variable_id), rule.cap_cents, self.const(rule)
+            self.emit(indent, "%s = []" % tmp)
+            self.rule(rule.inner_rule, tmp, indent)
+            self.emit(indent, "for line in %s:" % tmp)
+            self.emit(indent + 1, "v = %s.get(line.account_id, %s)" % (ctx, var))
+            self.emit(indent + 1, "if v >= %d:" % cap)
+            self.emit(indent + 2, "continue")
+            self.emit(indent + 1, "if v + line.cents > %d:" % cap)
+            self.emit(indent + 2, "line = InvoiceLine(line.account_id, line.date, line.item + \", rajattu\", %d - v, %s, line.event, line.ledger_account_id)" % (cap, r))
+            self.emit(indent + 1, "%s.set(line.account_id, %s, Cents(v + line.cents))" % (ctx, var))
+            self.emit(indent + 1, "%s.append(line)" % out)
+        elif cls is SetDateRule:
+            tmp = self.temp()
+            self.emit(indent, "%s = []" % tmp)
+            self.rule(rule.inner_rule, tmp, indent)
+            self.emit(indent, "for line in %s:" % tmp)
+            self.emit(indent + 1, "%s.set(line.account_id, %s, line.date.isoformat())" % (self.const(rule.context), self.literal(rule.variable_id)))
+            self.emit(indent, "%s.extend(%s)" % (out, tmp))
+        elif cls is SetLedgerYearRule:
+            tmp = self.temp()
+            self.emit(indent, "%s = []" % tmp)
+            self.rule(rule.inner_rule, tmp, indent)
+            self.emit(indent, "for line in %s:" % tmp)
+            self.emit(indent + 1, "if line.ledger_year is None:")
+            self.emit(indent + 2, "line.ledger_year = %s" % self.literal(rule.ledger_year))
+            self.emit(indent, "%s.extend(%s)" % (out, tmp))
+        else:
+            self.emit(indent, "%s.extend(%s.invoice(ev))" % (out, self.const(rule)))
+
+def generate_source(rule):
+    """
+    Return (source, constants) of module that defines function
+    invoice(ev), which is equivalent to rule.invoice(ev)
+
+    Constants must be in the module namespace when the source is executed.
+    """
+    gen = _Generator()
+    gen.emit(0, "# -*- coding: utf-8")
+    gen.emit(0, "# Generated by pik.codegen")
+    gen.emit(0, "def invoice(ev):")
+    gen.emit(1, "out = []")
+    gen.emit(1, "is_flight = isinstance(ev, Flight)")
+    gen.emit(1, "is_event = isinstance(ev, SimpleEvent)")
+    gen.emit(1, "date = ev.date")
+    gen.emit(1, "prices = ev.prices if is_flight else None")
+    gen.rule(rule, "out", 1)
+    gen.emit(1, "return out")
+    return "\n".join(gen.lines) + "\n", gen.constants
+
+def compile_source(source, cache_dir=None):
+    """
+    Compile generated source, or load compiled code from cache directory
+
+    Source is also written into the cache directory, so that tracebacks
+    from generated code show the source lines.
+    """
+    if cache_dir is None:
+        return compile(source, "<generated rules>", "exec")
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    key = hashlib.sha1(sys.version + source).hexdigest()
+    source_fname = os.path.join(cache_dir, key + ".py")
+    code_fname = os.path.join(cache_dir, key + ".code")
+    if os.path.exists(code_fname) and os.path.exists(source_fname):
+        with open(code_fname, "rb") as f:
+            return marshal.load(f)
+    code = compile(source, source_fname, "exec")
+    for fname, data in ((source_fname, source), (code_fname, marshal.dumps(code))):
+        fd, tmp_fname = tempfile.mkstemp(dir=cache_dir, prefix=".tmp-")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.rename(tmp_fname, fname)
+    return code
+
+_MISSING = object()
+
+class GeneratedRule(BaseRule):
+    """
+    Rule that evaluates given rule with generated code
+
+    For each event type, year and aircraft, the first verify_count events
+    are also billed with the original rule tree, and if the results differ
+    the original tree is used for the rest of the run. Caps only matter
+    when an account reaches them, so in addition every event that takes a
+    capped variable of an account to its cap is verified, and the first
+    verify_count events of each capped variable that find it at its cap.
+
+    :param inner_rule: Rule to compile
+    :param cache_dir: Directory for compiled code, or None
+    :param verify_count: Number of events to verify per key, None to verify
+                         all events and raise ValueError on a difference
+    """
+    def __init__(self, inner_rule, cache_dir=None, verify_count=10):
+        self.inner_rule = inner_rule
+        self.source, constants = generate_source(inner_rule)
+        namespace = dict(constants, Flight=Flight, SimpleEvent=SimpleEvent, InvoiceLine=InvoiceLine, Cents=Cents, to_cents=to_cents)
+        self.verify_count = verify_count
+        try:
+            exec compile_source(self.source, cache_dir) in namespace
+            self.function = namespace["invoice"]
+        except SyntaxError, e:
+            print >> sys.stderr, "Could not compile generated rules, using rule tree:", e
+            self.function = inner_rule.invoice
+            self.verify_count = 0
+        self._verified = {}
+        self._variables = _context_variables(inner_rule)
+        # (index in self._variables, cap) of capped variables, and number of
+        # verified events at cap by variable id
+        self._caps = [(self._variables.index((r.context, r.variable_id)), r.cap_cents)
+                      for r in walk_rules([inner_rule]) if isinstance(r, CappedRule) and not r.deferred]
+        self._variable_dicts = [(ctx.account_contexts, variable_id) for (ctx, variable_id) in self._variables]
+        self._verified_caps = {}
+
+    def invoice(self, event):
+        if self.verify_count is not None:
+            key = (event.__class__, event.date.year, getattr(event, "aircraft", None))
+            n = self._verified.get(key, 0)
+            if n >= self.verify_count:
+                if self._caps and self.verify_count:
+                    return self._cap_checked_invoice(event)
+                return self.function(event)
+            self._verified[key] = n + 1
+        return self._verified_invoice(event)
+
+    def _cap_checked_invoice(self, event):
+        account_id = event.account_id
+        before = [values.get((account_id, variable_id), _MISSING) for (values, variable_id) in self._variable_dicts]
+        lines = self.function(event)
+        for i, cap in self._caps:
+            values, variable_id = self._variable_dicts[i]
+            if values.get((account_id, variable_id), 0) >= cap:
+                if before[i] is not _MISSING and before[i] >= cap:
+                    n = self._verified_caps.get(variable_id, 0)
+                    if n >= self.verify_count:
+                        continue
+                    self._verified_caps[variable_id] = n + 1
+                # Event reached the cap, which happens once per account and variable
+                _restore([(ctx, (account_id, var)) for (ctx, var) in self._variables], before)
+                return self._verified_invoice(event)
+        return lines
+
+    def _verified_invoice(self, event):
+        keys = [(ctx, (event.account_id, variable_id)) for (ctx, variable_id) in self._variables]
+        before = [ctx.account_contexts.get(key, _MISSING) for (ctx, key) in keys]
+        expected = self.inner_rule.invoice(event)
+        expected_after = [ctx.account_contexts.get(key, _MISSING) for (ctx, key) in keys]
+        _restore(keys, before)
+        lines = self.function(event)
+        after = [ctx.account_contexts.get(key, _MISSING) for (ctx, key) in keys]
+        if map(_line_fields, lines) != map(_line_fields, expected) or after != expected_after:
+            if self.verify_count is None:
+                raise ValueError("Generated rules differ from rule tree for event %r" % event)
+            print >> sys.stderr, "Generated rules differ from rule tree for event", repr(event), ", using rule tree"
+            _restore(keys, expected_after)
+            self.function = self.inner_rule.invoice
+            self.verify_count = 0
+            return expected
+        return lines
+
+def _line_fields(line):
+    return (line.account_id, line.date, line.item, line.cents, line.rule_id, line.event_id, line.ledger_account_id, line.ledger_year, line.rollup)
+
+def _restore(keys, values):
+    for (ctx, key), value in zip(keys, values):
+        if value is _MISSING:
+            ctx.account_contexts.pop(key, None)
+        else:
+            ctx.account_contexts[key] = value
+
+def _context_variables(rule):
+    # (context, variable id) pairs that rules in the tree read or write
+    result = set()
+    for r in walk_rules([rule]):
+        if isinstance(r, (CappedRule, SetDateRule)):
+            result.add((r.context, r.variable_id))
+        for f in getattr(r, "filters", []):
+            while isinstance(f, NegationFilter):
+                f = f.filter
+            if isinstance(f, SinceDateFilter):
+                result.add((f.ctx, f.variable_id))
+    return list(result)
+
+def generate_rules(rules, cache_dir=None, verify_count=10):
+    """
+    Compile list of top-level rules, as used by events_to_lines
+    """
+    return [GeneratedRule(AllRules(rules), cache_dir, verify_count)]
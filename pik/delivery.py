@@ -0,0 +1,330 @@
+# -*- coding: utf-8
+#
+# Concurrent SMTP delivery
+#
+# Messages are sent by a pool of worker threads, each with its own SMTP
+# connection, and a shared token bucket keeps the total rate within the
+# limits of the provider. Messages that get a temporary failure, such as a
+# 451 throttle reply, go back into a queue with exponential backoff while
+# other messages are sent. Connections that were dropped are detected and
+# reopened by the worker that owns them.
+
+import heapq
+import smtplib
+import socket
+import sys
+import threading
+import time
+
+# Statuses of finished deliveries
+SENT = "sent"
+FAILED = "failed"
+
+class TokenBucket(object):
+    """
+    Rate limiter shared by threads
+
+    :param rate: Number of tokens added per second
+    :param burst: Maximum number of tokens saved up while idle
+    """
+    def __init__(self, rate, burst=1, clock=time.time, sleep=time.sleep):
+        self.rate = float(rate)
+        self.burst = max(1, burst)
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = float(self.burst)
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take a token, waiting until one is available
+        """
+        while True:
+            with self.lock:
+                now = self.clock()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            self.sleep(wait)
+
+class Delivery(object):
+    """
+    A message to a recipient, and the result of sending it
+
+    :param recipient_id: Identifier of the recipient used in log lines, e.g. account id
+    :param msg: Message as a string
+    """
+    def __init__(self, recipient_id, recipient_addr, msg):
+        self.recipient_id = recipient_id
+        self.recipient_addr = recipient_addr
+        self.msg = msg
+        self.attempts = 0
+        self.status = None
+        self.error = None
+
+def _temporary(code):
+    return 400 <= code < 500
+
+def _text(value):
+    if isinstance(value, str):
+        return value.decode("utf-8", "replace")
+    try:
+        return unicode(value)
+    except UnicodeError:
+        return repr(value).decode("utf-8", "replace")
+
+class DeliveryPool(object):
+    """
+    Send messages over a pool of SMTP connections
+
+    Connecting is retried after socket errors and temporary replies. Other
+    errors from connect, such as a wrong password, stop the pool, and the
+    messages that weren't sent yet are failed.
+
+    :param connect: Function that returns a new logged in SMTP connection
+    :param sender_addr: Envelope sender address
+    :param connections: Number of connections and worker threads
+    :param rate: Maximum number of messages per second over all connections, or None
+    :param burst: Number of messages that may be sent at once after an idle period
+    :param max_attempts: Number of attempts before a message is given up
+    :param retry_delay: Seconds before the first retry, doubled for each further retry
+    :param max_retry_delay: Maximum seconds between retries
+    :param idle_check: Seconds a connection may be idle before it's checked with NOOP
+    """
+    def __init__(self, connect, sender_addr, connections=1, rate=None, burst=1, max_attempts=10,
+                 retry_delay=60, max_retry_delay=600, idle_check=30, log=sys.stderr):
+        self.connect = connect
+        self.sender_addr = sender_addr
+        self.connections = max(1, connections)
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.idle_check = idle_check
+        self.log_file = log
+        self._log_lock = threading.Lock()
+        self._cond = threading.Condition()
+        # Heap of (time when ready to send, sequence number, delivery)
+        self._queue = []
+        self._seq = 0
+        self._pending = 0
+        # Connections are opened one at a time, so that a wrong password is only tried once
+        self._connect_lock = threading.Lock()
+        # Error that stopped the pool, or None
+        self._fatal = None
+
+    def log(self, *args):
+        line = u" ".join(_text(a) for a in args)
+        with self._log_lock:
+            print >> self.log_file, line.encode("utf-8")
+
+    def _put(self, delivery, ready_at):
+        # Caller holds self._cond
+        heapq.heappush(self._queue, (ready_at, self._seq, delivery))
+        self._seq += 1
+        self._cond.notify_all()
+
+    def _next(self):
+        """
+        Return next delivery that is ready to be sent, waiting if necessary,
+        or None when all deliveries are finished
+        """
+        with self._cond:
+            while True:
+                if not self._pending or self._fatal is not None:
+                    return None
+                now = time.time()
+                if self._queue and self._queue[0][0] <= now:
+                    return heapq.heappop(self._queue)[2]
+                # Wait with a timeout, so that the main thread stays interruptible
+                timeout = self._queue[0][0] - now if self._queue else 1.0
+                self._cond.wait(min(timeout, 1.0))
+
+    def _finish(self, delivery, status, error=None):
+        delivery.status = status
+        delivery.error = error
+        with self._cond:
+            self._pending -= 1
+            self._cond.notify_all()
+
+    def _retry(self, delivery, reason, delay=True):
+        """
+        Queue delivery again, with backoff if delay is set, or give up after max_attempts
+        """
+        if delivery.attempts >= self.max_attempts:
+            self.log("Giving up after", delivery.attempts, "attempts", delivery.recipient_id, delivery.recipient_addr, reason)
+            self._finish(delivery, FAILED, reason)
+            return
+        wait = min(self.retry_delay * 2 ** (delivery.attempts - 1), self.max_retry_delay) if delay else 0
+        with self._cond:
+            if self._fatal is None:
+                self._put(delivery, time.time() + wait)
+                return
+        self._finish(delivery, FAILED, self._fatal)
+
+    def _abort(self, error):
+        """
+        Stop the pool, failing all queued deliveries with given error
+        """
+        with self._cond:
+            if self._fatal is None:
+                self._fatal = error
+            queued = [entry[2] for entry in self._queue]
+            self._queue = []
+        for delivery in queued:
+            self._finish(delivery, FAILED, error)
+
+    def _connect(self, delivery):
+        """
+        Return new connection for sending delivery, or None if the delivery
+        was queued again or failed
+        """
+        with self._connect_lock:
+            if self._fatal is not None:
+                self._finish(delivery, FAILED, self._fatal)
+                return None
+            try:
+                return self.connect()
+            except smtplib.SMTPResponseException, e:
+                if not _temporary(e.smtp_code):
+                    return self._connect_failed(delivery, e)
+                error = e
+            except smtplib.SMTPServerDisconnected, e:
+                error = e
+            except smtplib.SMTPException, e:
+                # E.g. server doesn't support AUTH
+                return self._connect_failed(delivery, e)
+            except socket.error, e:
+                error = e
+            delivery.attempts += 1
+            self.log("Cannot connect, retrying later", delivery.recipient_id, delivery.recipient_addr, error)
+            self._retry(delivery, error)
+            return None
+
+    def _connect_failed(self, delivery, error):
+        self.log("Cannot connect, not retrying:", error)
+        self._finish(delivery, FAILED, error)
+        self._abort(error)
+        return None
+
+    def _send(self, conn, delivery):
+        """
+        Try to send delivery over conn, and return conn, or None if the
+        connection should be reopened
+        """
+        delivery.attempts += 1
+        try:
+            conn.sendmail(self.sender_addr, delivery.recipient_addr, delivery.msg)
+            self.log("Sent", delivery.recipient_id, delivery.recipient_addr)
+            self._finish(delivery, SENT)
+        except smtplib.SMTPRecipientsRefused, e:
+            error_code = e.recipients.values()[0][0]
+            if _temporary(error_code):
+                self.log("Throttled, retrying later", delivery.recipient_id, delivery.recipient_addr, e)
+                self._retry(delivery, e)
+            elif error_code == 501:
+                self.log("Invalid recipient, not retrying", delivery.recipient_id, delivery.recipient_addr, e)
+                self._finish(delivery, FAILED, e)
+            else:
+                self.log("Unknown error, not retrying", delivery.recipient_id, delivery.recipient_addr, e)
+                self._finish(delivery, FAILED, e)
+        except smtplib.SMTPServerDisconnected, e:
+            self.log("Connection dropped, reconnecting", delivery.recipient_id, delivery.recipient_addr, e)
+            self._retry(delivery, e, delay=False)
+            return None
+        except smtplib.SMTPResponseException, e:
+            if e.smtp_code == 421:
+                # Server is closing the connection
+                self.log("Connection closed by server, retrying later", delivery.recipient_id, delivery.recipient_addr, e)
+                self._retry(delivery, e)
+                return None
+            if _temporary(e.smtp_code):
+                self.log("Temporary error, retrying later", delivery.recipient_id, delivery.recipient_addr, e)
+                self._retry(delivery, e)
+            else:
+                self.log("Unknown error, not retrying", delivery.recipient_id, delivery.recipient_addr, e)
+                self._finish(delivery, FAILED, e)
+        except socket.error, e:
+            self.log("Connection error, reconnecting", delivery.recipient_id, delivery.recipient_addr, e)
+            self._retry(delivery, e, delay=False)
+            return None
+        except Exception, e:
+            self.log("Unknown exception type, not retrying", delivery.recipient_id, delivery.recipient_addr, e)
+            self._finish(delivery, FAILED, e)
+        return conn
+
+    def _alive(self, conn):
+        try:
+            return conn.noop()[0] == 250
+        except (smtplib.SMTPException, socket.error):
+            return False
+
+    def _worker(self):
+        conn = None
+        used = 0
+        try:
+            while True:
+                delivery = self._next()
+                if delivery is None:
+                    break
+                try:
+                    if conn is not None and time.time() - used > self.idle_check and not self._alive(conn):
+                        self.log("Idle connection dropped, reconnecting")
+                        _close(conn)
+                        conn = None
+                    if conn is None:
+                        conn = self._connect(delivery)
+                        if conn is None:
+                            continue
+                    if self.bucket is not None:
+                        self.bucket.acquire()
+                    new_conn = self._send(conn, delivery)
+                    if new_conn is None:
+                        _close(conn)
+                    conn = new_conn
+                    used = time.time()
+                except Exception, e:
+                    # Finish the delivery, so that the other workers don't wait for it
+                    if delivery.status is None:
+                        self._finish(delivery, FAILED, e)
+                    self.log("Unexpected error, not retrying", delivery.recipient_id, delivery.recipient_addr, e)
+                    if conn is not None:
+                        _close(conn)
+                        conn = None
+        finally:
+            if conn is not None:
+                try:
+                    conn.quit()
+                except (smtplib.SMTPException, socket.error):
+                    _close(conn)
+
+    def send_all(self, deliveries):
+        """
+        Send given deliveries, and return them with their status set to
+        SENT or FAILED
+        """
+        deliveries = list(deliveries)
+        with self._cond:
+            self._pending += len(deliveries)
+            for delivery in deliveries:
+                self._put(delivery, 0)
+        threads = [threading.Thread(target=self._worker, name="smtp-%d" % i)
+                   for i in range(min(self.connections, len(deliveries)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            # Join with a timeout, so that the main thread stays interruptible
+            while thread.is_alive():
+                thread.join(1.0)
+        return deliveries
+
+def _close(conn):
+    try:
+        conn.close()
+    except Exception:
+        pass
@@ -0,0 +1,165 @@
+# -*- coding: utf-8
+#
+# Rule compiler that builds dispatch indexes over a pik.rules tree
+#
+# The tree is walked once, and every AllRules/FirstRule node is replaced by an
+# indexed variant that only calls those inner rules that could produce lines
+# for the incoming event. Rules are skipped only when the filters they would
+# evaluate before reaching any stateful filter rule the event out, so the
+# produced lines and context side effects are the same as with the plain tree.
+
+from pik.event import SimpleEvent
+from pik.flights import Flight
+from pik.rules import AllRules, FirstRule, FlightRule, SimpleRule, CappedRule, SetDateRule, SetLedgerYearRule, DebugRule, ProfiledRule, PeriodFilter, AircraftFilter, PurposeFilter, ItemFilter, NegationFilter, TransferTowFilter, InvoicingChargeFilter, PositivePriceFilter, NegativePriceFilter, flightFilter, eventFilter
+import copy
+import datetime as dt
+
+# Filters that don't touch billing context or other state, and can thus be
+# skipped without changing the outcome of a billing run
+PURE_FILTER_TYPES = (PeriodFilter, AircraftFilter, PurposeFilter, ItemFilter, TransferTowFilter, InvoicingChargeFilter, PositivePriceFilter, NegativePriceFilter)
+
+def is_pure_filter(f):
+    if isinstance(f, NegationFilter):
+        return is_pure_filter(f.filter)
+    return isinstance(f, PURE_FILTER_TYPES) or f is flightFilter or f is eventFilter
+
+class GuardClause(object):
+    """
+    Necessary condition for a single leaf rule to produce lines
+
+    :param types: Event types the rule accepts, or None for any type
+    :param periods: Periods the event date must be in, all of them
+    :param aircraft: Aircraft the event must have, or None for any aircraft
+    """
+    def __init__(self, types=None, periods=(), aircraft=None):
+        self.types = types
+        self.periods = periods
+        self.aircraft = aircraft
+
+    def admits(self, event_type, year, aircraft):
+        if self.types is not None and not issubclass(event_type, self.types):
+            return False
+        if self.aircraft is not None and aircraft not in self.aircraft:
+            return False
+        start, end = dt.date(year, 1, 1), dt.date(year, 12, 31)
+        for period in self.periods:
+            if period.end < start or end < period.start:
+                return False
+        return True
+
+UNCONSTRAINED = [GuardClause()]
+
+def _filter_clause(types, filters):
+    periods = []
+    aircraft = None
+    for f in filters:
+        if not is_pure_filter(f):
+            # Filters after this one are not evaluated unless this one
+            # passes, and this one must be evaluated for its side effects
+            break
+        if isinstance(f, PeriodFilter):
+            periods.append(f.period)
+        elif isinstance(f, AircraftFilter):
+            if aircraft is None:
+                aircraft = frozenset(f.aircraft)
+            else:
+                aircraft = aircraft & frozenset(f.aircraft)
+        elif f is flightFilter:
+            types = (Flight,) if types is None or issubclass(Flight, types) else ()
+        elif f is eventFilter:
+            types = (SimpleEvent,) if types is None or issubclass(SimpleEvent, types) else ()
+    return GuardClause(types, tuple(periods), aircraft)
+
+def rule_guard(rule):
+    """
+    Return list of GuardClauses, one of which an event must satisfy for given
+    rule to produce lines or have side effects
+    """
+    if isinstance(rule, FlightRule):
+        return [_filter_clause((Flight,), rule.filters)]
+    if isinstance(rule, SimpleRule):
+        return [_filter_clause((SimpleEvent,), rule.filters)]
+    if isinstance(rule, (AllRules, FirstRule)):
+        result = []
+        for inner_rule in rule.inner_rules:
+            result.extend(rule_guard(inner_rule))
+        return result
+    if isinstance(rule, (CappedRule, SetDateRule, SetLedgerYearRule, ProfiledRule)):
+        return rule_guard(rule.inner_rule)
+    # DebugRule may report events that produce no lines, and nothing is known
+    # about other rule types
+    return UNCONSTRAINED
+
+class RuleIndex(object):
+    """
+    Index from event type, year and aircraft into those of given rules that
+    could produce lines for such events
+
+    Candidate lists are built on first use of each key, and preserve the
+    order of the rules.
+    """
+    def __init__(self, rules):
+        self.rules = list(rules)
+        self.guards = [rule_guard(rule) for rule in self.rules]
+        self._candidates = {}
+
+    def candidates(self, event):
+        key = (event.__class__, event.date.year, getattr(event, "aircraft", None))
+        try:
+            return self._candidates[key]
+        except KeyError:
+            result = tuple(rule for rule, guard in zip(self.rules, self.guards)
+                           if any(clause.admits(*key) for clause in guard))
+            self._candidates[key] = result
+            return result
+
+class IndexedAllRules(AllRules):
+    """
+    AllRules that only applies inner rules that could match the event
+    """
+    def __init__(self, inner_rules):
+        AllRules.__init__(self, inner_rules)
+        self.index = RuleIndex(inner_rules)
+
+    def invoice(self, event):
+        result = []
+        for rule in self.index.candidates(event):
+            result.extend(rule.invoice(event))
+        return result
+
+class IndexedFirstRule(FirstRule):
+    """
+    FirstRule that only tries inner rules that could match the event
+    """
+    def __init__(self, inner_rules):
+        FirstRule.__init__(self, inner_rules)
+        self.index = RuleIndex(inner_rules)
+
+    def invoice(self, event):
+        for rule in self.index.candidates(event):
+            lines = rule.invoice(event)
+            if lines:
+                return lines
+        return []
+
+def compile_rule(rule):
+    """
+    Return rule equivalent to given rule, with indexed AllRules and FirstRules
+
+    Wrapping rules are copied, leaf rules are shared with the original tree.
+    """
+    if isinstance(rule, AllRules):
+        return IndexedAllRules([compile_rule(r) for r in rule.inner_rules])
+    if isinstance(rule, FirstRule):
+        return IndexedFirstRule([compile_rule(r) for r in rule.inner_rules])
+    if isinstance(rule, (CappedRule, SetDateRule, SetLedgerYearRule, DebugRule)):
+        result = copy.copy(rule)
+        result.inner_rule = compile_rule(rule.inner_rule)
+        return result
+    return rule
+
+def compile_rules(rules):
+    """
+    Compile list of top-level rules, as used by events_to_lines
+    """
+    return [compile_rule(AllRules(rules))]
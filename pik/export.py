@@ -0,0 +1,127 @@
+# -*- coding: utf-8
+#
+# Bookkeeping export backends
+#
+# Transactions are pik.hansa.SimpleHansaTransaction objects whatever the
+# target format. A backend formats each transaction as text, and writes
+# transactions a block at a time, normalising and encoding each block with
+# a single call, which matters when years of transactions are exported at
+# once.
+
+from pik.money import format_cents
+import unicodedata
+
+class ExportBackend(object):
+    """
+    Base class of export backends
+
+    Subclasses implement format(txn), and header() if the format has one.
+    Transactions are buffered until close() or a full block.
+
+    :param f: Binary file to write into
+    :param encoding: Encoding of the file, default is that of the format
+    :param block_size: Number of transactions encoded at a time
+    """
+    # Default encoding and file name extension of the format
+    encoding = "utf-8"
+    extension = "txt"
+
+    def __init__(self, f, encoding=None, block_size=1000):
+        self.f = f
+        if encoding is not None:
+            self.encoding = encoding
+        self.block_size = block_size
+        self._block = []
+        header = self.header()
+        if header:
+            self._block.append(header)
+
+    def header(self):
+        return u""
+
+    def format(self, txn):
+        """
+        Return text of given transaction, ending with a line break
+        """
+        raise NotImplementedError()
+
+    def write(self, txn):
+        self._block.append(self.format(txn))
+        if len(self._block) >= self.block_size:
+            self.flush()
+
+    def flush(self):
+        if self._block:
+            # Lines end in line breaks, so normalising a block is the same as normalising each transaction
+            self.f.write(unicodedata.normalize("NFC", u"".join(self._block)).encode(self.encoding))
+            self._block = []
+
+    def close(self):
+        """
+        Write buffered transactions, the file is left open
+        """
+        self.flush()
+
+class HansaBackend(ExportBackend):
+    """
+    Hansa row import format, see pik.hansa.SimpleHansaTransaction.hansaformat
+    """
+    encoding = "iso-8859-15"
+
+    def format(self, txn):
+        return txn.hansaformat()
+
+def _csv_field(value):
+    value = unicode(value)
+    if any(c in value for c in u',"\r\n'):
+        return u'"' + value.replace(u'"', u'""') + u'"'
+    return value
+
+class CsvBackend(ExportBackend):
+    """
+    CSV with one line per transaction row, and a header line
+    """
+    extension = "csv"
+    fields = (u"txn_id", u"year", u"entry_date", u"txn_date", u"title", u"ref", u"account", u"row_title", u"debit", u"credit")
+
+    def header(self):
+        return u",".join(self.fields) + u"\r\n"
+
+    def format(self, txn):
+        cur = lambda cents: u"" if cents is None else format_cents(cents)
+        return u"".join(u",".join(_csv_field(value) for value in
+                                  (txn.txn_id, txn.year, txn.entry_date, txn.txn_date, txn.txn_title, txn.txn_ref,
+                                   row.account_no, row.row_title, cur(row.debit), cur(row.credit))) + u"\r\n"
+                        for row in txn.rows)
+
+def _sie_string(value):
+    return u'"' + unicode(value).replace(u"\\", u"\\\\").replace(u'"', u'\\"') + u'"'
+
+def _sie_date(date):
+    # Dates of transactions are dd.mm.yyyy
+    day, month, year = date.split(".")
+    return u"%04d%02d%02d" % (int(year), int(month), int(day))
+
+class SieBackend(ExportBackend):
+    """
+    SIE type 4 file of vouchers, amounts are positive for debit and
+    negative for credit
+    """
+    encoding = "cp437"
+    extension = "se"
+
+    def header(self):
+        return u"#FLAGGA 0\r\n#FORMAT PC8\r\n#SIETYP 4\r\n#PROGRAM \"pik-laskutin\" 1\r\n"
+
+    def format(self, txn):
+        lines = [u"#VER \"\" %d %s %s\r\n{\r\n" % (txn.txn_id, _sie_date(txn.txn_date), _sie_string(txn.txn_title))]
+        for row in txn.rows:
+            cents = row.debit if row.debit is not None else -row.credit
+            lines.append(u"#TRANS %d {} %s \"\" %s\r\n" % (row.account_no, format_cents(cents), _sie_string(row.row_title)))
+        lines.append(u"}\r\n")
+        return u"".join(lines)
+
+# Backends by format name
+BACKENDS = {"hansa": HansaBackend,
+            "csv": CsvBackend,
+            "sie": SieBackend}
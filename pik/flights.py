@@ -1,10 +1,22 @@
 # -*- coding: utf-8
+from array import array
+import csv
 import datetime as dt
+import itertools
+import operator
+import re
 import sys
+from pik.util import Record
+
+# Bump when output of Flight.generate_from_csv or the order of flights read
+# by invoice-flights.py changes, invalidates parse caches
+CSV_PARSER_VERSION = 4
 
 ALLOWED_PURPOSES = set(["GEO", "HAR", "HIN", "KOE", "KOU", "LAN", "LAS", "LVL", "MAT", "PALO", "RAH", "SAI", "SAR", "SII", "TAI", "TAR", "TIL", "VLL", "VOI", "YLE", "MUU", "KIL", "TYY"])
 
-class Flight(object):
+class Flight(Record):
+    __slots__ = ('aircraft', 'date', 'account_id', 'takeoff_time', 'landing_time', 'purpose', 'duration', 'invoicing_comment', 'transfer_tow', 'prices', 'event_id', '__weakref__')
+
     def __init__(self, aircraft, date, account_id, takeoff_time, landing_time, purpose, duration, invoicing_comment, extra_comments="", transfer_tow=False):
         self.aircraft = aircraft
         self.date = date # date object
@@ -25,6 +37,28 @@ class Flight(object):
         #self.extra_comments = extra_comments
         self.transfer_tow = transfer_tow 
         #self.deleted = False
+        self.prices = None # Set by pik.vectorized.BatchPricer
+        self.event_id = None # Assigned by pik.registry.EVENTS
+
+    @staticmethod
+    def trusted(aircraft, date, account_id, takeoff_time, landing_time, purpose, duration, invoicing_comment, transfer_tow):
+        """
+        Return Flight of values that have been validated already, purpose
+        must be in upper case
+        """
+        flight = Flight.__new__(Flight)
+        flight.aircraft = aircraft
+        flight.date = date
+        flight.account_id = account_id
+        flight.takeoff_time = takeoff_time
+        flight.landing_time = landing_time
+        flight.purpose = purpose
+        flight.duration = duration
+        flight.invoicing_comment = invoicing_comment
+        flight.transfer_tow = transfer_tow
+        flight.prices = None
+        flight.event_id = None
+        return flight
 
     def __unicode__(self):
         return "Flight(" + ", ".join([self.date.isoformat(), self.aircraft, self.account_id]) + ")"
@@ -70,6 +104,245 @@ class Flight(object):
                 print >> sys.stderr, "Unable to parse line %s" %row
                 raise
 
+class FlightLog(object):
+    """
+    Flight log stored as columns
+
+    Dates are stored as ordinals and durations as integers in arrays.
+    Aircraft, account ids, purposes, times and invoicing comments are stored
+    as indexes into tables of distinct values. Flight objects are built only
+    when the log is indexed or iterated.
+    """
+    def __init__(self):
+        self.aircraft_names = []
+        self.account_ids = []
+        self.purposes = []
+        self.texts = [] # Takeoff and landing times and invoicing comments
+        self.aircraft = array('H')
+        self.account = array('I')
+        self.date = array('i')
+        self.takeoff_time = array('I')
+        self.landing_time = array('I')
+        self.purpose = array('B')
+        self.duration = array('i')
+        self.invoicing_comment = array('I')
+        self.transfer_tow = array('B')
+
+    def __len__(self):
+        return len(self.date)
+
+    def __getitem__(self, i):
+        texts = self.texts
+        # Purposes were validated once per distinct value when the log was read
+        return Flight.trusted(self.aircraft_names[self.aircraft[i]], dt.date.fromordinal(self.date[i]),
+                              self.account_ids[self.account[i]], texts[self.takeoff_time[i]], texts[self.landing_time[i]],
+                              self.purposes[self.purpose[i]], self.duration[i], texts[self.invoicing_comment[i]],
+                              bool(self.transfer_tow[i]))
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    # Column arrays, one item per flight
+    _columns = ('aircraft', 'account', 'date', 'takeoff_time', 'landing_time', 'purpose', 'duration', 'invoicing_comment', 'transfer_tow')
+
+    def sort_by_date(self):
+        """
+        Sort flights by date, keeping flights of the same date in log order,
+        and return the log
+
+        Logs that are already in date order are left as they are.
+        """
+        date = self.date
+        if all(itertools.imap(operator.le, date, itertools.islice(date, 1, None))):
+            return self
+        order = sorted(xrange(len(date)), key=date.__getitem__)
+        for name in self._columns:
+            column = getattr(self, name)
+            setattr(self, name, array(column.typecode, map(column.__getitem__, order)))
+        return self
+
+    @staticmethod
+    def from_csv(rows):
+        """
+        Read flight log in the CSV format of Flight.generate_from_csv
+
+        Produces the same flights as Flight.generate_from_csv. Rows are
+        parsed in chunks, column by column, and each distinct cell value is
+        decoded and validated only once.
+        """
+        log = FlightLog()
+        parser = _ColumnParser(log)
+        rows = iter(rows)
+        first = list(itertools.islice(rows, 1))
+        if first and _is_header(first[0]):
+            first = []
+        rows = itertools.chain(first, rows)
+        for chunk in iter(lambda: list(itertools.islice(rows, CHUNK_ROWS)), []):
+            parser.parse(None, lambda: chunk)
+        return log
+
+    @staticmethod
+    def from_file(f):
+        """
+        Read flight log from CSV file, as from_csv(csv.reader(f))
+
+        Only the used columns are extracted from unquoted lines, with one
+        regular expression search per chunk, which is several times faster
+        than the csv module. Other lines are read with the csv module.
+        """
+        log = FlightLog()
+        parser = _ColumnParser(log)
+        first = f.readline()
+        if first and _is_header(next(csv.reader([first]))):
+            first = ""
+        for rows, csv_rows in _read_chunks(f, first):
+            parser.parse(rows, csv_rows)
+        return log
+
+def _is_header(row):
+    try:
+        int(row[13].decode("utf-8"))
+        return False
+    except ValueError:
+        return True
+
+# Columns used by FlightLog, the last one is missing from short rows
+_COLUMNS = (0, 1, 2, 6, 7, 8, 9, 12, 13, 14, 16)
+
+_get_columns = operator.itemgetter(*_COLUMNS[:-1])
+
+def _narrow_row(row):
+    """
+    Return tuple of used columns of CSV row
+    """
+    return _get_columns(row) + ((row[16],) if len(row) > 16 else ("",))
+
+# Number of rows that FlightLog.from_csv parses at a time
+CHUNK_ROWS = 10000
+# Number of bytes that FlightLog.from_file parses at a time
+CHUNK_BYTES = 1 << 20
+
+_VALUE, _SKIP = '([^,\r\n"]*)', '[^,\r\n"]*'
+# Unquoted line with 15 to 17 values
+_LINE_RE = re.compile("^" + ",".join(_VALUE if i in _COLUMNS else _SKIP for i in range(15)) +
+                      "(?:,%s(?:,%s)?)?\r?$" % (_SKIP, _VALUE), re.M)
+
+def _read_chunks(f, rest=""):
+    """
+    Read CSV file in chunks of whole lines
+
+    :param rest: Data read before the first chunk
+    :return: Iterator of (rows, csv_rows), where rows are tuples of used columns, or None if the chunk must be read with the csv module, and csv_rows returns rows read with the csv module
+    """
+    while True:
+        data = f.read(CHUNK_BYTES)
+        chunk, rest = rest + data, ""
+        if data:
+            end = chunk.rfind("\n") + 1
+            # Quoted value may contain line breaks
+            while end and chunk.count('"', 0, end) % 2:
+                end = chunk.rfind("\n", 0, end - 1) + 1
+            if not end:
+                rest = chunk
+                continue
+            chunk, rest = chunk[:end], chunk[end:]
+        if not chunk:
+            return
+        csv_rows = lambda chunk=chunk: list(csv.reader(chunk.splitlines(True)))
+        rows = None
+        if '"' not in chunk:
+            rows = _LINE_RE.findall(chunk)
+            if len(rows) != chunk.count("\n") + (not chunk.endswith("\n")):
+                rows = None # Some line has too few or too many values
+        yield rows, csv_rows
+
+class _Memo(dict):
+    """
+    Map from raw cell value to its parsed value
+    """
+    def __init__(self, parse):
+        dict.__init__(self)
+        self.parse = parse
+
+    def __missing__(self, raw):
+        value = self[raw] = self.parse(raw)
+        return value
+
+def _interner(table, parse):
+    """
+    Return map from raw cell value to index of its parsed value in table
+    """
+    def intern(raw):
+        table.append(parse(raw))
+        return len(table) - 1
+    return _Memo(intern)
+
+def _decode(raw):
+    return raw.decode("utf-8")
+
+def _parse_date(raw):
+    return dt.date(*map(int, raw.decode("utf-8").split("-"))).toordinal()
+
+def _parse_purpose(raw):
+    purpose = raw.decode("utf-8")
+    if purpose.upper() not in ALLOWED_PURPOSES:
+        raise ValueError("Invalid prpose of flights: %s, allowed values are: %s" %(purpose, ALLOWED_PURPOSES))
+    return purpose.upper()
+
+def _check_locations(raw):
+    locations = [x.decode("utf-8") for x in raw]
+    if _flight_has_different_tz(locations):
+        raise Exception("Flight to weird timezone, times? Check ICAO codes: " + str(locations))
+    return True
+
+class _ColumnParser(object):
+    def __init__(self, log):
+        self.log = log
+        self.aircraft = _interner(log.aircraft_names, _decode)
+        self.account = _interner(log.account_ids, lambda raw: str(raw.decode("utf-8")))
+        self.purpose = _interner(log.purposes, _parse_purpose)
+        self.text = _interner(log.texts, _decode)
+        self.date = _Memo(_parse_date)
+        self.locations = _Memo(_check_locations)
+
+    def columns(self, rows):
+        """
+        Return list of (column array, values) for given tuples of used columns
+        """
+        col = lambda i: map(operator.itemgetter(i), rows)
+        text = self.text.__getitem__
+        map(self.locations.__getitem__, zip(col(3), col(4)))
+        return [(self.log.aircraft, map(self.aircraft.__getitem__, col(0))),
+                (self.log.date, map(self.date.__getitem__, col(1))),
+                (self.log.account, map(self.account.__getitem__, col(2))),
+                (self.log.takeoff_time, map(text, col(5))),
+                (self.log.landing_time, map(text, col(6))),
+                (self.log.purpose, map(self.purpose.__getitem__, col(7))),
+                (self.log.duration, map(int, col(8))),
+                (self.log.invoicing_comment, map(text, col(9))),
+                (self.log.transfer_tow, map(bool, col(10)))]
+
+    def parse(self, rows, csv_rows):
+        """
+        Append rows to the log, or report the first invalid row and raise
+
+        :param rows: Tuples of used columns, or None to use csv_rows
+        :param csv_rows: Function that returns the same rows as read by the csv module
+        """
+        try:
+            columns = self.columns(rows if rows is not None else map(_narrow_row, csv_rows()))
+        except Exception:
+            for row in csv_rows():
+                try:
+                    self.columns([_narrow_row(row)])
+                except Exception:
+                    print >> sys.stderr, "Unable to parse line %s" % [x.decode("utf-8", "replace") for x in row]
+                    raise
+            raise
+        for column, values in columns:
+            column.fromlist(values)
+
 def _flight_has_different_tz(locations):
     same_tz = ["ef", "ee", "zz", "pirtti", "ey"]
     for _loc in locations:
@@ -1,5 +1,7 @@
 # -*- coding: utf-8
 
+from pik.money import format_cents
+import itertools
 
 class SimpleHansaTransaction(object):
     """
@@ -32,13 +34,13 @@ class SimpleHansaTransaction(object):
 
     def hansaformat(self):
         out = []
-        def cur(amount):
-            if amount is None:
+        def cur(cents):
+            if cents is None:
                 return ""
             else:
-                return ("%.2f" %amount).replace(".", ",")
+                return format_cents(cents, ",")
+        TXN = u"%d\t%d\t%s\t%s\t%s\t%s" %(self.txn_id, self.year, self.entry_date, self.txn_title, self.txn_date, self.txn_ref)
         for row in self.rows:
-            TXN = u"%d\t%d\t%s\t%s\t%s\t%s" %(self.txn_id, self.year, self.entry_date, self.txn_title, self.txn_date, self.txn_ref)
             ROW = u"\t%d\t\t%s\t\t\t%s\t%s\t\t\t\t\t" %(row.account_no, row.row_title, cur(row.debit), cur(row.credit))
             out.append(TXN + ROW)
         return u"\r\n".join(out) + "\r\n"
@@ -51,12 +53,12 @@ class SimpleHansaRow(object):
         """
         :param account_no: Hansa account number
         :param row_title: Short row title
-        :param debit: Debit amount
-        :parma credit: Credit amount
+        :param debit: Debit amount, in cents
+        :parma credit: Credit amount, in cents
         :type account_no: int
         :type row_title: string
-        :type debit: float
-        :type credit: float
+        :type debit: int
+        :type credit: int
         """
         self.account_no = account_no
         self.row_title = row_title
@@ -68,9 +70,43 @@ class SimpleHansaRow(object):
 
     def __str__(self):
         if self.credit is not None:
-            return "HansaRow(%d, %s, credit=%.2f)" % (self.account_no, self.row_title, self.credit)
+            return "HansaRow(%d, %s, credit=%s)" % (self.account_no, self.row_title, format_cents(self.credit))
         else:
-            return "HansaRow(%d, %s, debit=%.2f)" % (self.account_no, self.row_title, self.debit)
+            return "HansaRow(%d, %s, debit=%s)" % (self.account_no, self.row_title, format_cents(self.debit))
+
+    def sort_key(self):
+        return (self.account_no, self.row_title, self.debit, self.credit)
 
     def __cmp__(self, other):
-        return cmp((self.account_no, self.row_title, self.debit, self.credit), (other.account_no, other.row_title, other.debit, other.credit))
+        return cmp(self.sort_key(), other.sort_key())
+
+class HansaExportWriter(object):
+    """
+    Writer of export files with one transaction per account
+
+    Transactions are passed to an export backend as they are added, see
+    pik.export.
+    """
+    def __init__(self, backend, first_txn_id, year, entry_date, txn_date):
+        """
+        :param backend: Export backend to write into, e.g. pik.export.HansaBackend
+        :param first_txn_id: Hansa transaction identifier of the first transaction
+        :param year: Transaction year, see SimpleHansaTransaction
+        :param entry_date: Entry date, see SimpleHansaTransaction
+        :param txn_date: Transaction date, see SimpleHansaTransaction
+        """
+        self.backend = backend
+        self.txn_ids = itertools.count(first_txn_id)
+        self.year = year
+        self.entry_date = entry_date
+        self.txn_date = txn_date
+
+    def add(self, account_id, rows):
+        """
+        Write transaction of given account with given SimpleHansaRows, if there are any
+        """
+        if rows:
+            self.backend.write(SimpleHansaTransaction(self.txn_ids.next(), self.year, self.entry_date, self.txn_date, "Lentolasku, " + account_id, account_id, rows))
+
+    def close(self):
+        self.backend.close()
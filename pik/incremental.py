@@ -0,0 +1,143 @@
+# -*- coding: utf-8
+#
+# State for incremental rebilling
+#
+# All billing rules are per account, so an account whose input events and
+# starting context are the same as in the previous run gets the same invoice
+# and the same final context. The state file keeps, for each account, a
+# digest of its inputs, its final context variables and its rendered
+# outputs, so that only changed accounts need to be billed again.
+
+import cPickle as pickle
+import hashlib
+import os
+import tempfile
+
+# Bump when the format of state files changes
+STATE_VERSION = 1
+
+def run_signature(source_fnames, settings):
+    """
+    Digest of the program and settings that produce the outputs. State
+    from a run with a different signature is not reused.
+
+    :param source_fnames: Source and data files of the program, .pyc names are read as .py
+    :param settings: JSON-like settings that affect output
+    """
+    h = hashlib.sha1()
+    for fname in sorted(set(fname[:-1] if fname.endswith(".pyc") else fname for fname in source_fnames)):
+        with open(fname, "rb") as f:
+            h.update(f.read())
+    h.update(repr(sorted(settings.items())))
+    return h.hexdigest()
+
+def event_fields(event):
+    """
+    Return identifying fields of an event, as a tuple
+    """
+    return (event.__class__.__name__,) + tuple(getattr(event, name, None) for name in event.__slots__
+                                              if name not in ('prices', 'event_id', '__weakref__'))
+
+def context_by_account(ctx):
+    """
+    Return dict from account id to sorted list of its context items
+    """
+    result = {}
+    for key, value in ctx.account_contexts.iteritems():
+        result.setdefault(key[0], []).append((key, value))
+    for items in result.itervalues():
+        items.sort()
+    return result
+
+def account_digests(events, ctx):
+    """
+    Return dict from account id to digest of its events and starting context
+
+    :param events: All events of the run, in billing order
+    :param ctx: Starting billing context
+    :type ctx: pik.billing.BillingContext
+    """
+    hashes = {}
+    for event in events:
+        try:
+            h = hashes[event.account_id]
+        except KeyError:
+            h = hashes[event.account_id] = hashlib.sha1()
+        h.update(repr(event_fields(event)))
+    for account_id, items in context_by_account(ctx).iteritems():
+        try:
+            h = hashes[account_id]
+        except KeyError:
+            h = hashes[account_id] = hashlib.sha1()
+        h.update("ctx" + repr(items))
+    return dict((account_id, h.hexdigest()) for (account_id, h) in hashes.iteritems())
+
+class AccountState(object):
+    __slots__ = ('digest', 'context', 'outputs')
+
+    def __init__(self, digest, context, outputs):
+        """
+        :param digest: Digest of the account's events and starting context
+        :param context: Final context items of the account
+        :param outputs: Rendered outputs of the account, or None if it wasn't invoiced
+        """
+        self.digest = digest
+        self.context = context
+        self.outputs = outputs
+
+class BillingState(object):
+    """
+    Per-account inputs and outputs of the previous billing run
+    """
+    def __init__(self, signature):
+        self.signature = signature
+        self.accounts = {}
+        self.files = set() # Output files shared by all accounts
+
+    @staticmethod
+    def load(fname, signature):
+        """
+        Load state from given file, or return empty state if the file
+        doesn't exist or was written with a different signature
+        """
+        state = BillingState(signature)
+        if os.path.exists(fname):
+            with open(fname, "rb") as f:
+                version, file_signature, accounts, files = pickle.load(f)
+            if version == STATE_VERSION and file_signature == signature:
+                state.accounts = accounts
+                state.files = files
+        return state
+
+    def save(self, fname):
+        fd, tmp_fname = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(fname)), prefix=".tmp-")
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump((STATE_VERSION, self.signature, self.accounts, self.files), f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_fname, fname)
+
+    def changed_accounts(self, digests):
+        """
+        Return set of accounts whose digest differs from the previous run,
+        including accounts that no longer have any inputs
+        """
+        changed = set(account_id for (account_id, digest) in digests.iteritems()
+                      if account_id not in self.accounts or self.accounts[account_id].digest != digest)
+        changed.update(account_id for account_id in self.accounts if account_id not in digests)
+        return changed
+
+    def update(self, account_id, digest, context, outputs):
+        if digest is None:
+            self.accounts.pop(account_id, None)
+        else:
+            self.accounts[account_id] = AccountState(digest, context, outputs)
+
+    def restore_context(self, ctx, account_ids):
+        """
+        Set final context variables of given accounts from the previous run
+        """
+        for account_id in account_ids:
+            for ((_, variable_id), value) in self.accounts[account_id].context:
+                ctx.set(account_id, variable_id, value)
+
+    def invoiced_accounts(self):
+        return sorted(account_id for (account_id, account) in self.accounts.iteritems() if account.outputs is not None)
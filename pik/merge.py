@@ -0,0 +1,144 @@
+# -*- coding: utf-8
+#
+# Ordered merging of event sources
+#
+# Billing needs all events in date order. Sources are put in order
+# separately and merged lazily. Sources that are almost in order are kept
+# in memory, sources that are further out of order are sorted in bounded
+# memory, spilling sorted runs into temporary files.
+
+import heapq
+import itertools
+import cPickle as pickle
+import tempfile
+
+# Number of entries pickled at a time into run files
+_RUN_BATCH = 1000
+
+class _RunWriter(object):
+    """
+    Temporary file of sorted entries, pickled in batches
+
+    Memo of the pickler is cleared after each batch, so that it doesn't
+    keep the whole run in memory.
+    """
+    def __init__(self):
+        self.f = tempfile.TemporaryFile()
+        self.pickler = pickle.Pickler(self.f, pickle.HIGHEST_PROTOCOL)
+        self.batch = []
+
+    def add(self, entry):
+        self.batch.append(entry)
+        if len(self.batch) >= _RUN_BATCH:
+            self._dump()
+
+    def _dump(self):
+        self.pickler.dump(self.batch)
+        self.pickler.clear_memo()
+        self.batch = []
+
+    def finish(self):
+        if self.batch:
+            self._dump()
+        self.f.seek(0)
+        return self.f
+
+def _read_run(f):
+    unpickler = pickle.Unpickler(f)
+    try:
+        while True:
+            for entry in unpickler.load():
+                yield entry
+    except EOFError:
+        pass
+    finally:
+        f.close()
+
+def external_sort(items, key, run_size):
+    """
+    Sort items of arbitrary order
+
+    Sorted runs are produced with replacement selection through a heap of
+    run_size items. Items that are at most run_size positions out of order
+    form a single run, which is kept in memory and costs about as much as a
+    reorder buffer. When an item further out of order is found, the runs
+    are spilled into temporary files and merged, holding about run_size
+    items in memory from there on. Items must be picklable. Sort is stable.
+    """
+    first_run = []
+    runs = []
+    writer = None
+    run_no = 0
+    for entry in _replacement_selection(items, key, run_size):
+        if entry[0] != run_no:
+            runs.append(writer.finish() if writer is not None else _spill(first_run))
+            first_run = []
+            writer = _RunWriter()
+            run_no = entry[0]
+        if writer is None:
+            first_run.append(entry[1:])
+        else:
+            writer.add(entry[1:])
+    if writer is None:
+        # Single run, nothing was spilled
+        for _, _, item in first_run:
+            yield item
+        return
+    runs.append(writer.finish())
+    for _, _, item in _heap_merge([_read_run(f) for f in runs]):
+        yield item
+
+def _replacement_selection(items, key, heap_size):
+    """
+    Generate (run number, key, seq, item) of items in sorted runs, an item
+    that sorts before the last one of the current run goes to the next run
+    """
+    entries = enumerate(items)
+    heap = [(0, key(item), seq, item) for (seq, item) in itertools.islice(entries, heap_size)]
+    heapq.heapify(heap)
+    for seq, item in entries:
+        entry = heap[0]
+        item_key = key(item)
+        heapq.heapreplace(heap, (entry[0] if item_key >= entry[1] else entry[0] + 1, item_key, seq, item))
+        yield entry
+    while heap:
+        yield heapq.heappop(heap)
+
+def _spill(run):
+    writer = _RunWriter()
+    for entry in run:
+        writer.add(entry)
+    return writer.finish()
+
+def _heap_merge(iterables):
+    # Merge iterables of (key, ...) tuples that are each in order
+    heap = []
+    for iterable in iterables:
+        it = iter(iterable)
+        for entry in it:
+            heap.append((entry, it))
+            break
+    heapq.heapify(heap)
+    while heap:
+        entry, it = heap[0]
+        yield entry
+        for entry in it:
+            heapq.heapreplace(heap, (entry, it))
+            break
+        else:
+            heapq.heappop(heap)
+
+def merge(sources, key):
+    """
+    Lazily merge ordered sources into one ordered stream
+
+    Result is the same as sorted(chain(*sources), key=key) would be: items
+    with equal keys come in the order of their sources, and in source order
+    within a source.
+    """
+    keyed = [_keyed(source, key, source_no) for (source_no, source) in enumerate(sources)]
+    return (item for (_, _, _, item) in _heap_merge(keyed))
+
+def _keyed(items, key, source_no):
+    for seq, item in enumerate(items):
+        yield (key(item), source_no, seq, item)
@@ -0,0 +1,71 @@
+# -*- coding: utf-8
+#
+# Money as integer cents
+#
+# Billing sums and compares money on every invoice line, so amounts are kept
+# as integer cents, which add exactly and cheaply. Conversion to Decimal or
+# to text happens only when writing output.
+
+import decimal
+
+CENT = decimal.Decimal('.01')
+
+class Cents(int):
+    """
+    Integer amount of cents that is stored in a billing context
+
+    Marks context variables that hold money, so they can be converted to
+    euros when the context is written out.
+    """
+    __slots__ = ()
+
+    def __repr__(self):
+        return "Cents(%d)" % self
+
+def to_cents(value):
+    """
+    Convert amount of euros to integer cents, rounding half to even
+
+    Floats are rounded by their exact binary value, the same way as
+    Decimal(value).quantize(CENT) would round them.
+
+    :param value: Euros as int, float, Decimal or string, or a Cents value
+    """
+    if isinstance(value, Cents):
+        return int(value)
+    if isinstance(value, (int, long)):
+        return value * 100
+    if isinstance(value, float):
+        n, d = value.as_integer_ratio()
+        q, r = divmod(n * 100, d)
+        if 2 * r > d or (2 * r == d and q % 2):
+            q += 1
+        return q
+    if not isinstance(value, decimal.Decimal):
+        value = decimal.Decimal(value)
+    return int(value.scaleb(2).to_integral_value(decimal.ROUND_HALF_EVEN))
+
+def format_cents(cents, decimal_point="."):
+    """
+    Format integer cents as euros with two decimals, e.g. -12.30
+    """
+    sign = "-" if cents < 0 else ""
+    euros, cents = divmod(abs(cents), 100)
+    return "%s%d%s%02d" % (sign, euros, decimal_point, cents)
+
+def to_decimal(cents):
+    """
+    Convert integer cents to Decimal euros with two decimals
+    """
+    # Parsing is faster than Decimal arithmetic
+    return decimal.Decimal(format_cents(cents))
+
+def hourly_cents(minutes, euros_per_hour):
+    """
+    Price in cents of given number of minutes at given hourly price, rounded
+    to the nearest cent
+
+    Both arguments must be integers. The exact price is a multiple of 1/3
+    cents, so it is never halfway between two cents.
+    """
+    return (minutes * euros_per_hour * 5 + 1) // 3
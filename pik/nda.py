@@ -1,5 +1,14 @@
 # -*- coding: utf-8 -*-
 import datetime as dt
+from array import array
+import bisect
+import cPickle as pickle
+import mmap
+import os
+from pik.util import Record
+
+# Bump when output of transactions() changes, invalidates parse caches
+PARSER_VERSION = 3
 
 def findrecord(records, maintype, subtype):
     for record in records:
@@ -21,7 +30,9 @@ def debank(str):
     u = str.decode('latin-1')
     return u.translate(debanktable)
 
-class Transaction(object):
+class Transaction(Record):
+    __slots__ = ('id', 'iban', 'bic', 'date', 'ledger_date', 'value_date', 'payment_date', 'name', 'cents', 'metarecord', 'mainrecord', 'extrarecords', 'receipt', 'is_receipt', 'receipt_txns', 'ref', 'msg', 'ourref', 'recipient_iban', 'recipient_bic', 'operation')
+
     def __init__(self, metarecord, mainrecord, extrarecords=[], receipt_txns=[]):
         self.id = mainrecord.id
 
@@ -77,7 +88,9 @@ class Transaction(object):
     def __str__(self):
         return self.mainrecord.str
 
-class Record00(object):
+class Record00(Record):
+    __slots__ = ('type', 'str')
+
     def __init__(self, str):
         self.type = '00'
         self.str = str
@@ -93,90 +106,99 @@ class Record00(object):
     def __str__(self):
         return self.str.strip()
 
-class Record10(object):
+# Fixed-width column layout of T10 records
+T10_COLUMNS = {
+    'ledger_date': slice(1+2+3+6+18, 1+2+3+6+18+6),
+    'payment_date': slice(1+2+3+6+24, 1+2+3+6+24+6),
+    'value_date': slice(1+2+3+6+30, 1+2+3+6+30+6),
+    'operation': slice(52, 52+35),
+    'sign': slice(87, 88),
+    'amount': slice(88, 88+18),
+    'receipt': slice(106, 107),
+    'name': slice(108, 108+35),
+    'ref': slice(159, 159+20),
+    'is_receipt': slice(187, 188),
+}
+
+_yymmdd_cache = {}
+
+def parse_yymmdd(datestr):
+    """
+    Parse YYMMDD date like strptime with "%y%m%d" does, years 69-99 are in the 1900s
+    """
+    try:
+        return _yymmdd_cache[datestr]
+    except KeyError:
+        pass
+    if len(datestr) != 6 or not datestr.isdigit():
+        raise ValueError("Invalid YYMMDD date %r" % datestr)
+    yy = int(datestr[0:2])
+    date = dt.date(yy + (1900 if yy >= 69 else 2000), int(datestr[2:4]), int(datestr[4:6]))
+    _yymmdd_cache[datestr] = date
+    return date
+
+class Record10(Record):
     """
     New transaction
 
     e.g.
 T101880000311305272588WWNU02851305271305271305272720Itsepalvelu                        -000000000000044625 AJeppesen GbmH                      A                                            
 T10188000001130506258883E248871305061305061305062730Palvelumaksu                       -000000000000000982EJNORDEA PANKKI SUOMI OYJ            J                                            
-    """
-    def __init__(self, str):
-        self.type = '10'
-        self.str = str
 
+    All fields are decoded once, when the record is created.
+    """
+    __slots__ = ('str', 'ledger_date', 'value_date', 'payment_date', 'name', 'receipt', 'is_receipt', 'operation', 'cents', 'ref')
 
-    @property
-    def id(self):
-        datestr = self.str[12:12+18]
+    type = '10'
 
-    @property
-    def date(self):
-        return self.ledger_date
+    def __init__(self, str, columns=T10_COLUMNS):
+        self.str = str
 
-    @property
-    def ledger_date(self):
-        datestr = self.str[1+2+3+6+18:1+2+3+6+18+6]
         try:
-            return dt.datetime.strptime(datestr, "%y%m%d").date()
+            self.ledger_date = parse_yymmdd(str[columns['ledger_date']])
         except:
-            raise Exception("No ledger date in", self.str)
+            raise Exception("No ledger date in", str)
 
-    @property
-    def value_date(self):
-        datestr = self.str[1+2+3+6+30:1+2+3+6+30+6]
         try:
-            return dt.datetime.strptime(datestr, "%y%m%d").date()
+            self.value_date = parse_yymmdd(str[columns['value_date']])
         except:
-            raise Exception("No value date in", self.str)
+            raise Exception("No value date in", str)
 
-    @property
-    def payment_date(self):
-        datestr = self.str[1+2+3+6+24:1+2+3+6+24+6]
+        datestr = str[columns['payment_date']]
         if datestr == "000000":
-            return None
+            self.payment_date = None
         else:
-            return dt.datetime.strptime(datestr, "%y%m%d").date()
+            self.payment_date = parse_yymmdd(datestr)
 
-    @property
-    def name(self):
-        return debank(self.str[108:108+35]).rstrip(' ')
-
-    @property
-    def receipt(self):
-        return self.str[106].strip()
-
-    @property
-    def is_receipt(self):
+        self.name = debank(str[columns['name']]).rstrip(' ')
+        self.receipt = str[columns['receipt']].strip()
         # TODO Doesn't distinguish between receipt levels
-        return bool(self.str[187].strip())
+        self.is_receipt = bool(str[columns['is_receipt']].strip())
+        self.operation = debank(str[columns['operation']]).rstrip(' ')
+        self.cents = int(str[columns['sign']] + str[columns['amount']].lstrip('0'))
 
-    @property
-    def operation(self):
-        return debank(self.str[52:52+35]).rstrip(' ')
+        ref = str[columns['ref']].lstrip(' ')
+        if ref:
+            self.ref = ref.lstrip('0')
+        else:
+            self.ref = None
 
     @property
-    def cents(self):
-        sign = self.str[87:88]
-        num = self.str[88:88+18]
-        return int(sign + num.lstrip('0'))
+    def id(self):
+        datestr = self.str[12:12+18]
 
     @property
-    def euros(self):
-        return float("%.2f" % (self.cents()/100.0))
+    def date(self):
+        return self.ledger_date
 
     @property
-    def ref(self):
-        ref = self.str[159:159+20].lstrip(' ')
-        if ref:
-            return ref.lstrip('0')
-        else:
-            return None
+    def euros(self):
+        return float("%.2f" % (self.cents/100.0))
 
     def __str__(self):
         return self.str.strip()
 
-class Record11(object):
+class Record11(Record):
     """
     Additional information for a transaction?
 
@@ -188,6 +210,8 @@ T110780670160263718201000455
 
     It seems that T1132311 is receiver account in some format, T1104300 is a free-form message and T1107806 is a defined-format refrence number
     """
+    __slots__ = ('type', 'subtype', 'str', 'ref', 'msg', 'ourref', 'recipient_iban', 'recipient_bic')
+
     def __init__(self, str):
         self.type = '11'
         self.subtype = str[6:8]
@@ -217,9 +241,15 @@ def complex_txn(txn_buf):
     main_txn = txn_buf[0]
     return Transaction(main_txn.metarecord, main_txn.mainrecord, main_txn.extrarecords, txn_buf[1:])
 
-def transactions(lines):
+def transactions(lines, ctx=None):
+    """
+    Generate transactions from NDA lines, with receipt transactions grouped
+    under the transaction they belong to
+
+    :param ctx: Account header record for lines before the first T00 record
+    """
     txn_buf = []
-    for txn in simple_transactions(lines):
+    for txn in simple_transactions(lines, ctx):
         if not txn_buf and not txn.receipt and not txn.is_receipt:
             # Normal transaction and empty buffer
             yield txn
@@ -244,8 +274,7 @@ def transactions(lines):
         # End of stream, yield anything that's in the buffer
         yield complex_txn(txn_buf)
 
-def simple_transactions(lines):
-    ctx = None
+def simple_transactions(lines, ctx=None):
     buf = []
     for l in lines:
         if l.startswith('T00'):
@@ -270,6 +299,133 @@ def simple_transactions(lines):
     if buf:
         yield Transaction(ctx, buf[0], buf[1:])
 
+# Bump when the format of IndexedStatement index files changes
+INDEX_VERSION = 1
+
+class StatementSection(object):
+    """
+    Index of one account section of a statement: offsets of its T00 header,
+    its body and its end, and of its top-level T10 records with their ledger dates
+    """
+    def __init__(self, header_offset, body_offset, iban):
+        self.header_offset = header_offset
+        self.body_offset = body_offset
+        self.end_offset = body_offset
+        self.iban = iban
+        self.ordinals = array('i')
+        self.offsets = array('l')
+        # Whether ledger dates are known and in order, so that date ranges can be bisected
+        self.ordered = True
+
+class IndexedStatement(object):
+    """
+    Memory-mapped NDA statement file with an index of its account sections
+
+    The index is kept in a sidecar file next to the statement and rebuilt when
+    the statement changes. Transactions within a date range are read by seeking
+    directly to the first transaction of the range.
+    """
+    def __init__(self, fname, index_fname=None):
+        self.fname = fname
+        self.index_fname = index_fname or fname + ".idx"
+        with open(fname, 'rb') as f:
+            st = os.fstat(f.fileno())
+            self.stamp = (st.st_size, st.st_mtime)
+            if st.st_size:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.data = ''
+        self.sections = self._load_index()
+        if self.sections is None:
+            self.sections = self._build_index()
+            self._save_index()
+
+    def _load_index(self):
+        try:
+            with open(self.index_fname, 'rb') as f:
+                version, stamp, sections = pickle.load(f)
+        except (IOError, EOFError, ValueError, TypeError, pickle.UnpicklingError):
+            return None
+        if version != INDEX_VERSION or stamp != self.stamp:
+            return None
+        return sections
+
+    def _save_index(self):
+        tmp_fname = self.index_fname + ".tmp"
+        try:
+            with open(tmp_fname, 'wb') as f:
+                pickle.dump((INDEX_VERSION, self.stamp, self.sections), f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_fname, self.index_fname)
+        except (IOError, OSError):
+            # Index can't be stored, e.g. read-only archive; it is rebuilt next time
+            pass
+
+    def _lines(self, offset, end_offset):
+        data = self.data
+        while offset < end_offset:
+            nl = data.find('\n', offset, end_offset)
+            if nl < 0:
+                nl = end_offset - 1
+            yield data[offset:nl+1]
+            offset = nl + 1
+
+    def _build_index(self):
+        sections = []
+        section = None
+        offset = 0
+        for line in self._lines(0, len(self.data)):
+            if line.startswith('T00'):
+                try:
+                    iban = Record00(line).iban
+                except IndexError:
+                    iban = None
+                section = StatementSection(offset, offset + len(line), iban)
+                sections.append(section)
+            elif section is not None:
+                if line.startswith('T10') and not line[187:188].strip():
+                    # Transactions that are not receipts of the previous one start a new transaction group
+                    try:
+                        ordinal = parse_yymmdd(line[T10_COLUMNS['ledger_date']]).toordinal()
+                    except ValueError:
+                        ordinal = 0
+                        section.ordered = False
+                    if section.ordinals and ordinal < section.ordinals[-1]:
+                        section.ordered = False
+                    section.ordinals.append(ordinal)
+                    section.offsets.append(offset)
+            offset += len(line)
+            if section is not None:
+                section.end_offset = offset
+        return sections
+
+    def transactions(self, start=None, end=None, iban=None):
+        """
+        Generate transactions whose ledger date is within given period, grouped like transactions() does
+
+        :param start: First ledger date, inclusive, or None for no limit
+        :param end: Last ledger date, inclusive, or None for no limit
+        :param iban: Only read sections of this account, or None for all accounts
+        """
+        for section in self.sections:
+            if iban is not None and section.iban != iban:
+                continue
+            if not section.offsets:
+                continue
+            pos = 0
+            if section.ordered and start is not None:
+                pos = bisect.bisect_left(section.ordinals, start.toordinal())
+                if pos == len(section.offsets):
+                    continue
+            ctx = Record00(self.data[section.header_offset:section.body_offset])
+            for txn in transactions(self._lines(section.offsets[pos], section.end_offset), ctx):
+                if end is not None and txn.date > end:
+                    if section.ordered:
+                        break
+                    continue
+                if start is not None and txn.date < start:
+                    continue
+                yield txn
+
 if __name__ == '__main__':
     import csv
     import sys
@@ -0,0 +1,142 @@
+# -*- coding: utf-8
+#
+# Output files of a billing round
+#
+# Outputs are written into a staging directory next to out_dir, which is
+# renamed to out_dir when complete, so that out_dir never holds a partial
+# round. Invoices are rendered in forked worker processes that inherit the
+# invoice list, and either written one file per account, or collected into
+# a single zip or tar archive with an index, for rounds with tens of
+# thousands of members.
+
+from pik.money import format_cents
+from pik.util import invoice_template
+import contextlib
+import csv
+import itertools
+import multiprocessing
+import os
+import shutil
+import StringIO
+import tarfile
+import tempfile
+import time
+import zipfile
+
+# Name of the index in invoice archives
+ARCHIVE_INDEX = "index.csv"
+
+# Invoice rendering state inherited by forked workers: (invoices, out_dir, additional_details, format)
+_worker_state = None
+
+@contextlib.contextmanager
+def atomic_dir(out_dir):
+    """
+    Context manager that creates a staging directory next to out_dir, and
+    renames it to out_dir when the body completes
+
+    If the body raises an exception, the staging directory is removed and
+    out_dir is not created.
+    """
+    if os.path.exists(out_dir):
+        raise ValueError("out_dir already exists: " + out_dir)
+    parent = os.path.dirname(os.path.abspath(out_dir))
+    if not os.path.exists(parent):
+        os.makedirs(parent)
+    staging = tempfile.mkdtemp(prefix="." + os.path.basename(os.path.normpath(out_dir)) + ".", dir=parent)
+    # Same permissions as os.makedirs would give, instead of private to the user
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(staging, 0777 & ~umask)
+    try:
+        yield staging
+    except:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    os.rename(staging, out_dir)
+
+def invoice_fname(invoice):
+    return invoice.account_id + ".txt"
+
+def _write_files(bounds):
+    invoices, out_dir, additional_details, format = _worker_state
+    template = invoice_template(format)
+    for invoice in invoices[bounds[0]:bounds[1]]:
+        with open(os.path.join(out_dir, invoice_fname(invoice)), "wb") as f:
+            template.write(f, invoice, additional_details)
+    return bounds[1] - bounds[0]
+
+def _render(bounds):
+    invoices, out_dir, additional_details, format = _worker_state
+    template = invoice_template(format)
+    return [template.render(invoice, additional_details).encode("utf-8") for invoice in invoices[bounds[0]:bounds[1]]]
+
+def _map_chunks(func, invoices, out_dir, additional_details, format, processes, chunk_size):
+    """
+    Return results of func for chunks of invoices in order, computed in
+    worker processes if processes is given
+    """
+    global _worker_state
+    chunks = [(start, min(start + chunk_size, len(invoices))) for start in xrange(0, len(invoices), chunk_size)]
+    _worker_state = (invoices, out_dir, additional_details, format)
+    try:
+        if not processes or len(chunks) < 2:
+            return [func(chunk) for chunk in chunks]
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(func, chunks)
+            pool.close()
+            return results
+        finally:
+            pool.terminate()
+            pool.join()
+    finally:
+        _worker_state = None
+
+def write_invoice_files(invoices, out_dir, additional_details="", format="2015", processes=None, chunk_size=500):
+    """
+    Write text of each invoice into out_dir/<account id>.txt
+
+    :param processes: Number of worker processes, or None to write in this process
+    :param chunk_size: Number of invoices written by a worker at a time
+    """
+    _map_chunks(_write_files, list(invoices), out_dir, additional_details, format, processes, chunk_size)
+
+def write_invoice_archive(invoices, fname, additional_details="", format="2015", processes=None, chunk_size=500):
+    """
+    Write text of invoices into a single archive as <account id>.txt, with
+    index.csv of account id, file name and total of each invoice as the
+    first member
+
+    The archive is a zip file if fname ends with .zip, otherwise a tar
+    file, compressed if fname ends with .gz or .tgz.
+
+    :param processes: Number of worker processes, or None to render in this process
+    :param chunk_size: Number of invoices rendered by a worker at a time
+    """
+    invoices = list(invoices)
+    index = StringIO.StringIO()
+    csv.writer(index).writerows((invoice.account_id, invoice_fname(invoice), format_cents(invoice.total_cents()))
+                                for invoice in invoices)
+    texts = itertools.chain.from_iterable(_map_chunks(_render, invoices, None, additional_details, format, processes, chunk_size))
+    members = itertools.chain([(ARCHIVE_INDEX, index.getvalue())],
+                              ((invoice_fname(invoice), text) for (invoice, text) in itertools.izip(invoices, texts)))
+    now = time.time()
+
+    if fname.endswith(".zip"):
+        date_time = time.localtime(now)[:6]
+        with contextlib.closing(zipfile.ZipFile(fname, "w", zipfile.ZIP_DEFLATED)) as archive:
+            for name, data in members:
+                info = zipfile.ZipInfo(name, date_time)
+                info.compress_type = zipfile.ZIP_DEFLATED
+                info.external_attr = 0644 << 16
+                archive.writestr(info, data)
+    else:
+        mode = "w:gz" if fname.endswith((".gz", ".tgz")) else "w"
+        with contextlib.closing(tarfile.open(fname, mode)) as archive:
+            for name, data in members:
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                info.mtime = now
+                info.mode = 0644
+                archive.addfile(info, StringIO.StringIO(data))
@@ -0,0 +1,81 @@
+# -*- coding: utf-8
+#
+# Per-account sharded billing
+#
+# All billing state is per account, so the date-ordered event stream can be
+# split into shards of whole accounts that are billed independently. Shards
+# are billed in forked worker processes that inherit the rule tree and the
+# billing context, and send back their invoice lines and the context
+# variables of their own accounts.
+
+from pik.billing import InvoiceLine
+from pik.rules import walk_rules
+import multiprocessing
+
+# Billing state inherited by forked workers: (shards, rules, context, lines_func)
+_worker_state = None
+
+def partition_events(events, n_shards):
+    """
+    Split events into n_shards lists so that all events of an account are in
+    the same list. Relative order of events is preserved within each list.
+    """
+    shards = [[] for _ in range(n_shards)]
+    shard_by_account = {}
+    for event in events:
+        try:
+            shard = shard_by_account[event.account_id]
+        except KeyError:
+            shard = shard_by_account[event.account_id] = shards[len(shard_by_account) % n_shards]
+        shard.append(event)
+    return [s for s in shards if s]
+
+def _bill_shard(shard_no):
+    shards, rules, ctx, lines_func, rule_ids = _worker_state
+    events = shards[shard_no]
+    event_positions = dict((id(event), i) for (i, event) in enumerate(events))
+    lines = []
+    for line in lines_func(events, rules):
+        lines.append((event_positions.get(id(line.event)), rule_ids[id(line.rule)],
+                      line.account_id, line.date, line.item, line.cents,
+                      line.ledger_account_id, line.ledger_year, line.rollup))
+    accounts = set(event.account_id for event in events)
+    ctx_items = [(k, v) for (k, v) in ctx.account_contexts.iteritems() if k[0] in accounts]
+    return lines, ctx_items
+
+def sharded_lines(events, rules, ctx, lines_func, processes, shards_per_process=4):
+    """
+    Produce the same invoice lines as lines_func(events, rules), billing
+    accounts in parallel
+
+    Lines of each account are produced in the same order as by lines_func,
+    but lines of different accounts are interleaved differently. Context
+    variables of billed accounts are written back into ctx.
+
+    :param events: Date-ordered events
+    :param rules: Rules to apply, must use ctx as their billing context
+    :param ctx: Billing context
+    :param lines_func: Function that produces invoice lines from events and rules, e.g. events_to_lines
+    :param processes: Number of worker processes
+    :type ctx: pik.billing.BillingContext
+    """
+    global _worker_state
+    shards = partition_events(events, processes * shards_per_process)
+    rules_by_id = list(walk_rules(rules))
+    rule_ids = dict((id(rule), i) for (i, rule) in enumerate(rules_by_id))
+
+    _worker_state = (shards, rules, ctx, lines_func, rule_ids)
+    pool = multiprocessing.Pool(processes)
+    try:
+        for shard_no, (lines, ctx_items) in enumerate(pool.imap(_bill_shard, range(len(shards)))):
+            events = shards[shard_no]
+            for (event_pos, rule_id, account_id, date, item, cents, ledger_account_id, ledger_year, rollup) in lines:
+                event = events[event_pos] if event_pos is not None else None
+                yield InvoiceLine(account_id, date, item, cents, rules_by_id[rule_id], event, ledger_account_id, ledger_year, rollup)
+            for (account_id, variable_id), value in ctx_items:
+                ctx.set(account_id, variable_id, value)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        _worker_state = None
@@ -0,0 +1,218 @@
+# -*- coding: utf-8
+#
+# Price tables of billing seasons
+#
+# Prices of each season are kept in a JSON file instead of code. A season
+# lists hourly prices of aircraft, glider prices with package and course
+# rates, per-flight fees, the capped equipment fee and the context variables
+# of season packages. Each season is compiled into a tree of pik.rules
+# objects, in the same shape as the seasons were written by hand before.
+#
+# File format, "comment" keys are allowed everywhere and ignored:
+#
+# {"accounts": {"<name>": <ledger account id>, ...},
+#  "seasons": [{"year": 2021,
+#               "period": ["2021-01-01", "2021-12-31"], // optional, default is the year
+#               "packages": {"pursi": {"variable": "<context variable>", "item": "<event item regex>"},
+#                            "kurssi": {...}},           // item is optional
+#               "flights": [{"aircraft": ["TOW"], "price": 104, "account": "<name>",
+#                            "period": [...], "template": "...", // optional
+#                            "transfer_tow": {"price": 104, "account": "<name>", "template": "..."}}], // optional
+#               "gliders": {"account": "<name>",
+#                           "prices": [{"aircraft": ["650"], "price": 15, "kurssi_price": 0, "package_price": 0}]},
+#               "instruction_fee": {"aircraft": [...], "price": 5, "account": "<name>"},
+#               "equipment_fee": {"price": 10, "account": "<name>", "cap": 90, "variable": "<context variable>",
+#                                 "groups": [{"aircraft": [...], "cap": 70, "variable": "<context variable>",
+#                                             "transfer_tows": false}]}, // optional, default true
+#               "invoicing_charge": {"aircraft": [...], "price": 2, "account": "<name>"}}]}
+#
+# Prices of flights, gliders and the equipment fee are hourly, prices of
+# instruction fees and invoicing charges are per flight. All prices and caps
+# are in euros.
+
+from pik.rules import FlightRule, SimpleRule, AllRules, FirstRule, CappedRule, SetDateRule, SetLedgerYearRule, PeriodFilter, AircraftFilter, PurposeFilter, ItemFilter, SinceDateFilter, NegationFilter, TransferTowFilter, InvoicingChargeFilter, PositivePriceFilter, NegativePriceFilter
+from pik.util import Period, parse_iso8601_date
+import hashlib
+import json
+import numbers
+
+FLIGHT_TEMPLATE = u"Lento, %(aircraft)s, %(duration)d min"
+TRANSFER_TOW_TEMPLATE = u"Siirtohinaus, %(duration)d min"
+PACKAGE_TEMPLATE = u"Lento, pursiköntällä, %(aircraft)s, %(duration)d min"
+COURSE_TEMPLATE = u"Lento, kurssiköntällä, %(aircraft)s, %(duration)d min, %(purpose)s"
+INSTRUCTION_FEE_TEMPLATE = u"Koululentomaksu, %(aircraft)s"
+EQUIPMENT_FEE_TEMPLATE = u"Kalustomaksu, %(aircraft)s, %(duration)d min"
+INVOICING_CHARGE_TEMPLATE = u"Laskutuslisä, %(aircraft)s, %(invoicing_comment)s"
+
+# Order in which season packages are tried for simple events
+PACKAGES = ("pursi", "kurssi")
+
+def _check(value, where, required=(), optional=()):
+    """
+    Check that value is an object with given keys
+    """
+    if not isinstance(value, dict):
+        raise ValueError("Price tables: %s must be an object" % where)
+    for key in required:
+        if key not in value:
+            raise ValueError("Price tables: %s has no %s" % (where, key))
+    for key in value:
+        if key not in required and key not in optional and key != "comment":
+            raise ValueError("Price tables: unknown key %s in %s" % (key, where))
+    for key in ("price", "kurssi_price", "package_price", "cap"):
+        if key in value and not isinstance(value[key], numbers.Number):
+            raise ValueError("Price tables: %s of %s must be a number" % (key, where))
+    return value
+
+def _check_season(season, where, accounts):
+    _check(season, where, ("year",), ("period", "packages", "flights", "gliders", "instruction_fee", "equipment_fee", "invoicing_charge"))
+    entries = []
+    for name, package in season.get("packages", {}).iteritems():
+        if name not in PACKAGES:
+            raise ValueError("Price tables: unknown package %s in %s" % (name, where))
+        _check(package, "%s.packages.%s" % (where, name), ("variable",), ("item",))
+    for i, flight in enumerate(season.get("flights", [])):
+        entries.append(_check(flight, "%s.flights[%d]" % (where, i), ("aircraft", "price", "account"), ("period", "template", "transfer_tow")))
+        if "transfer_tow" in flight:
+            entries.append(_check(flight["transfer_tow"], "%s.flights[%d].transfer_tow" % (where, i), ("price", "account"), ("template",)))
+    if "gliders" in season:
+        entries.append(_check(season["gliders"], where + ".gliders", ("account", "prices")))
+        for i, glider in enumerate(season["gliders"]["prices"]):
+            _check(glider, "%s.gliders.prices[%d]" % (where, i), ("aircraft", "price"), ("kurssi_price", "package_price"))
+    for key in ("instruction_fee", "invoicing_charge"):
+        if key in season:
+            entries.append(_check(season[key], where + "." + key, ("aircraft", "price", "account")))
+    if "equipment_fee" in season:
+        entries.append(_check(season["equipment_fee"], where + ".equipment_fee", ("price", "account", "cap", "variable", "groups")))
+        for i, group in enumerate(season["equipment_fee"]["groups"]):
+            _check(group, "%s.equipment_fee.groups[%d]" % (where, i), ("aircraft", "cap", "variable"), ("transfer_tows",))
+    for entry in entries:
+        if entry["account"] not in accounts:
+            raise ValueError("Price tables: unknown account %s in %s" % (entry["account"], where))
+
+def _period(value):
+    return Period(parse_iso8601_date(value[0]), parse_iso8601_date(value[1]))
+
+def _aircraft(value):
+    if isinstance(value, basestring):
+        return AircraftFilter(value)
+    return AircraftFilter(*value)
+
+def _per_flight(price):
+    return lambda event: price
+
+class PriceTables(object):
+    """
+    Seasons of a price table file
+
+    :param accounts: Dict from account name to ledger account id
+    :param seasons: List of seasons, as in the file
+    :param digest: SHA-1 digest of the file
+    """
+    def __init__(self, accounts, seasons, digest):
+        self.accounts = accounts
+        self.seasons = seasons
+        self.digest = digest
+
+    @staticmethod
+    def load(fname):
+        """
+        Load and check price tables from given JSON file
+        """
+        with open(fname, "rb") as f:
+            data = f.read()
+        tables = _check(json.loads(data), fname, ("accounts", "seasons"))
+        years = set()
+        for i, season in enumerate(tables["seasons"]):
+            _check_season(season, "seasons[%d]" % i, tables["accounts"])
+            if season["year"] in years:
+                raise ValueError("Price tables: season %d is defined twice" % season["year"])
+            years.add(season["year"])
+        return PriceTables(tables["accounts"], tables["seasons"], hashlib.sha1(data).hexdigest())
+
+    def season_period(self, season):
+        """
+        Return period of events that rules of given season may match
+        """
+        if "period" in season:
+            period = _period(season["period"])
+        else:
+            period = Period.full_year(season["year"])
+        for flight in season.get("flights", []):
+            if "period" in flight:
+                flight_period = _period(flight["period"])
+                period = Period(min(period.start, flight_period.start), max(period.end, flight_period.end))
+        return period
+
+    def register(self, rule_sets, ctx):
+        """
+        Register rules of each season as a set in given pik.rulesets.LazyRules
+
+        :param ctx: Billing context of package and cap variables
+        """
+        for season in self.seasons:
+            rule_sets.register(season["year"], self.season_period(season), lambda season=season: self.rules(season, ctx))
+
+    def rules(self, season, ctx):
+        """
+        Compile given season into list of rules
+        """
+        accounts = self.accounts
+        if "period" in season:
+            period = [PeriodFilter(_period(season["period"]))]
+        else:
+            period = [PeriodFilter(Period.full_year(season["year"]))]
+        packages = season.get("packages", {})
+        rules = []
+
+        for flight in season.get("flights", []):
+            filters = [_aircraft(flight["aircraft"])]
+            filters += [PeriodFilter(_period(flight["period"]))] if "period" in flight else period
+            rule = FlightRule(flight["price"], accounts[flight["account"]], filters, flight.get("template", FLIGHT_TEMPLATE))
+            if "transfer_tow" in flight:
+                # Transfer tows are priced separately, other flights with the same aircraft as usual
+                tow = flight["transfer_tow"]
+                rule = FirstRule([FlightRule(tow["price"], accounts[tow["account"]], filters + [TransferTowFilter()], tow.get("template", TRANSFER_TOW_TEMPLATE)),
+                                  rule])
+            rules.append(rule)
+
+        if "gliders" in season:
+            account = accounts[season["gliders"]["account"]]
+            for glider in season["gliders"]["prices"]:
+                base_filters = period + [_aircraft(glider["aircraft"])]
+                glider_rules = []
+                if "pursi" in packages:
+                    glider_rules.append(FlightRule(glider.get("package_price", 0), account, base_filters + [SinceDateFilter(ctx, packages["pursi"]["variable"])], PACKAGE_TEMPLATE))
+                if "kurssi" in packages:
+                    glider_rules.append(FlightRule(glider.get("kurssi_price", 0), account, base_filters + [SinceDateFilter(ctx, packages["kurssi"]["variable"])], COURSE_TEMPLATE))
+                glider_rules.append(FlightRule(glider["price"], account, base_filters))
+                rules.append(FirstRule(glider_rules))
+
+        if "instruction_fee" in season:
+            fee = season["instruction_fee"]
+            rules.append(FlightRule(_per_flight(fee["price"]), accounts[fee["account"]],
+                                    [_aircraft(fee["aircraft"])] + period + [PurposeFilter("KOU")], INSTRUCTION_FEE_TEMPLATE))
+
+        if "equipment_fee" in season:
+            fee = season["equipment_fee"]
+            groups = []
+            for group in fee["groups"]:
+                filters = period + [_aircraft(group["aircraft"])]
+                if not group.get("transfer_tows", True):
+                    filters.append(NegationFilter(TransferTowFilter()))
+                groups.append(CappedRule(group["variable"], group["cap"], ctx,
+                                         FlightRule(fee["price"], accounts[fee["account"]], filters, EQUIPMENT_FEE_TEMPLATE)))
+            rules.append(CappedRule(fee["variable"], fee["cap"], ctx, AllRules(groups)))
+
+        # Purchases of packages set their start dates, other simple events are billed as is
+        event_rules = [SetDateRule(packages[name]["variable"], ctx, SimpleRule(period + [ItemFilter(packages[name]["item"])]))
+                       for name in PACKAGES if "item" in packages.get(name, {})]
+        rules.append(FirstRule(event_rules + [SimpleRule(period + [PositivePriceFilter()]),
+                                              SimpleRule(period + [NegativePriceFilter()])]))
+
+        if "invoicing_charge" in season:
+            fee = season["invoicing_charge"]
+            rules.append(FlightRule(_per_flight(fee["price"]), accounts[fee["account"]],
+                                    [_aircraft(fee["aircraft"])] + period + [InvoicingChargeFilter()], INVOICING_CHARGE_TEMPLATE))
+
+        return [SetLedgerYearRule(AllRules(rules), season["year"])]
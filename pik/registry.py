@@ -0,0 +1,67 @@
+# -*- coding: utf-8
+#
+# Compact integer ids for rules and events
+#
+# Invoice lines refer to the rule and the event that produced them by id,
+# instead of holding references to them. Rules live for the whole run and
+# are kept by the registry. Events are only referenced weakly, so that an
+# event can be freed once it has been billed.
+
+import weakref
+
+class RuleRegistry(object):
+    def __init__(self):
+        self._rules = []
+        self._ids = {}
+
+    def id_of(self, rule):
+        """
+        Return id of given rule, registering it on first use
+        """
+        if rule is None:
+            return None
+        try:
+            return self._ids[id(rule)]
+        except KeyError:
+            rule_id = self._ids[id(rule)] = len(self._rules)
+            self._rules.append(rule)
+            return rule_id
+
+    def get(self, rule_id):
+        if rule_id is None:
+            return None
+        return self._rules[rule_id]
+
+class EventRegistry(object):
+    """
+    Registry of events, which must have an event_id attribute and support
+    weak references
+    """
+    def __init__(self):
+        self._events = weakref.WeakValueDictionary()
+        self._next_id = 0
+
+    def id_of(self, event):
+        """
+        Return id of given event, registering it on first use
+        """
+        if event is None:
+            return None
+        event_id = event.event_id
+        if event_id is None or self._events.get(event_id) is not event:
+            # Not registered, or registered in another process before pickling
+            event_id = event.event_id = self._next_id
+            self._next_id += 1
+            self._events[event_id] = event
+        return event_id
+
+    def get(self, event_id):
+        """
+        Return event with given id, or None if the event no longer exists
+        """
+        if event_id is None:
+            return None
+        return self._events.get(event_id)
+
+RULES = RuleRegistry()
+EVENTS = EventRegistry()
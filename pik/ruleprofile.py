@@ -0,0 +1,122 @@
+# -*- coding: utf-8
+#
+# Per-rule profiling of rule trees
+#
+# Every node of a rule tree is wrapped in a pik.rules.ProfiledRule, which
+# counts calls, calls that produced lines and time spent in the node. After
+# a run the report lists the nodes that took most time, rules that never
+# produced lines, and how often each branch of each FirstRule ended the
+# search. Branches that win more often than the ones before them are
+# candidates for reordering, if their conditions don't overlap.
+
+from pik.rules import FlightRule, SimpleRule, AllRules, FirstRule, CappedRule, SetDateRule, SetLedgerYearRule, ProfiledRule, inner_rules_of
+import copy
+
+def profile_rule(rule):
+    """
+    Return copy of given rule tree with every node wrapped in a ProfiledRule
+
+    Wrapping rules are copied, leaf rules are shared with the original tree.
+    Wrap before pik.dispatch.compile_rules, so that the indexes see the
+    guards of the wrapped rules.
+    """
+    if isinstance(rule, (AllRules, FirstRule)):
+        result = copy.copy(rule)
+        result.inner_rules = [profile_rule(r) for r in rule.inner_rules]
+    elif getattr(rule, "inner_rule", None) is not None:
+        result = copy.copy(rule)
+        result.inner_rule = profile_rule(rule.inner_rule)
+    else:
+        result = rule
+    return ProfiledRule(result)
+
+def profile_rules(rules):
+    return [profile_rule(rule) for rule in rules]
+
+def describe(rule):
+    """
+    Return short description of given rule, without its inner rules
+    """
+    if isinstance(rule, FlightRule):
+        price = rule.price if isinstance(rule.price, (int, long, float)) else "per flight"
+        aircraft = [sorted(f.aircraft) for f in rule.filters if hasattr(f, "aircraft")]
+        return u"FlightRule %s, account %s, aircraft %s, %s" % (price, rule.ledger_account_id,
+                                                               ",".join(",".join(a) for a in aircraft) or "any", rule.template)
+    if isinstance(rule, SimpleRule):
+        return u"SimpleRule %s" % ", ".join(f.__class__.__name__ for f in rule.filters)
+    if isinstance(rule, (CappedRule, SetDateRule)):
+        return u"%s %s" % (rule.__class__.__name__, rule.variable_id)
+    if isinstance(rule, SetLedgerYearRule):
+        return u"SetLedgerYearRule %s" % rule.ledger_year
+    return rule.__class__.__name__
+
+def _unwrap(rule):
+    while isinstance(rule, ProfiledRule):
+        rule = rule.inner_rule
+    return rule
+
+def profiled_nodes(rules, path=u""):
+    """
+    Generate (path, profiled rule, profiled inner rules) of all profiled
+    nodes in given rule trees, parents before their inner rules
+
+    Path consists of indexes and descriptions of the rules from the root,
+    AllRules and FirstRules are shown by index only.
+    """
+    for i, rule in enumerate(rules):
+        inner = _unwrap(rule)
+        if isinstance(inner, (AllRules, FirstRule)):
+            step = u"%d" % i
+        elif len(rules) > 1:
+            step = u"%d %s" % (i, describe(inner))
+        else:
+            step = describe(inner)
+        node_path = path + u"/" + step if path else step
+        children = inner_rules_of(inner)
+        if isinstance(rule, ProfiledRule):
+            yield node_path, rule, [r for r in children if isinstance(r, ProfiledRule)]
+        for result in profiled_nodes(children, node_path):
+            yield result
+
+def to_json(rules):
+    """
+    Return profile of all nodes as JSON-like list, in tree order
+    """
+    result = []
+    for path, rule, children in profiled_nodes(rules):
+        inner = _unwrap(rule)
+        node = {'path': path, 'rule': describe(inner), 'calls': rule.calls, 'matches': rule.matches, 'lines': rule.lines,
+                'seconds': round(rule.time, 6), 'self_seconds': round(rule.time - sum(c.time for c in children), 6)}
+        if isinstance(inner, FirstRule):
+            node['branch_calls'] = [c.calls for c in children]
+            node['branch_matches'] = [c.matches for c in children]
+        elif isinstance(inner, (FlightRule, SimpleRule)):
+            node['leaf'] = True
+        result.append(node)
+    return result
+
+def report(rules, limit=20):
+    """
+    Return hotspot report of profiled rules as text
+    """
+    nodes = to_json(rules)
+    lines = [u"Rule hotspots by self time:",
+             u"%10s %10s %10s %10s %8s  %s" % ("Self s", "Total s", "Calls", "Matches", "Lines", "Rule")]
+    for node in sorted(nodes, key=lambda node: -node['self_seconds'])[:limit]:
+        lines.append(u"%10.3f %10.3f %10d %10d %8d  %s" % (node['self_seconds'], node['seconds'], node['calls'],
+                                                            node['matches'], node['lines'], node['path']))
+
+    lines.append(u"FirstRule branches, matches/calls of each branch in order:")
+    for node in nodes:
+        if 'branch_matches' not in node or not node['calls']:
+            continue
+        branches = [u"%d/%d" % pair for pair in zip(node['branch_matches'], node['branch_calls'])]
+        best = max(node['branch_matches'])
+        reorder = best and node['branch_matches'].index(best) > 0
+        lines.append(u"  %s: %s%s" % (node['path'], u" ".join(branches), u"  (later branch matches most)" if reorder else u""))
+
+    lines.append(u"Rules that never matched:")
+    for node in nodes:
+        if node.get('leaf') and not node['matches']:
+            lines.append(u"  %s (%d calls)" % (node['path'], node['calls']))
+    return u"\n".join(lines)
@@ -7,11 +7,12 @@
 from pik.event import SimpleEvent
 from pik.flights import Flight
 from pik.billing import InvoiceLine
+from pik.money import Cents, to_cents, hourly_cents
 import datetime as dt
 import re
 import numbers
 import sys
-import decimal
+import time
 
 class BaseRule(object):
     # Don't allow multiple ledger accounts for lines produced by a rule by default
@@ -30,6 +31,31 @@ class DebugRule(BaseRule):
             self.debug_func(event, result)
         return result
 
+class ProfiledRule(DebugRule):
+    """
+    Rule that records how its inner rule is used: calls, calls that
+    produced lines, lines produced and time spent in the inner rule,
+    including its filters
+
+    See pik.ruleprofile for wrapping every node of a rule tree.
+    """
+    def __init__(self, inner_rule):
+        DebugRule.__init__(self, inner_rule, debug_filter=lambda event, result: False)
+        self.calls = 0
+        self.matches = 0
+        self.lines = 0
+        self.time = 0.0
+
+    def invoice(self, event):
+        start = time.time()
+        result = self.inner_rule.invoice(event)
+        self.time += time.time() - start
+        self.calls += 1
+        if result:
+            self.matches += 1
+            self.lines += len(result)
+        return result
+
 class SimpleRule(BaseRule):
     """
     Simple rule for SimpleEvents
@@ -46,7 +72,7 @@ class SimpleRule(BaseRule):
     def invoice(self, event):
         if isinstance(event, SimpleEvent):
             if all(f(event) for f in self.filters):
-                return [InvoiceLine(event.account_id, event.date, event.item, event.amount, self, event, event.ledger_account_id, event.ledger_year, event.rollup)]
+                return [InvoiceLine(event.account_id, event.date, event.item, event.cents, self, event, event.ledger_account_id, event.ledger_year, event.rollup)]
         return []
 
 class SinceDateFilter(object):
@@ -152,41 +178,57 @@ class PositivePriceFilter(object):
     Match SimpleEvents with price 0 or greater
     """
     def __call__(self, event):
-        return event.amount >= 0
+        return event.cents >= 0
 
 class NegativePriceFilter(object):
     """
     Match SimpleEvents with price less than 0
     """
     def __call__(self, event):
-        return event.amount < 0
+        return event.cents < 0
 
 class FlightRule(BaseRule):
     """
     Produce one InvoiceLine from a Flight event if it matches all the
     filters, priced with given price, and with description derived from given template.
     """
+    # Set by pik.vectorized.BatchPricer if the rule is batch priced
+    batch_id = None
+
     def __init__(self, price, ledger_account_id, filters=[], template="Lento, %(aircraft)s, %(duration)d min"):
         """
         :param price: Hourly price, in euros, or pricing function that takes Flight event as parameter and returns price
         :param ledger_account_id: Ledger account id of the other side of the transaction (income account)
         :param filters: Input filters (such as per-aircraft)
-        :param template: Description tmeplate. Filled using string formatting with the event object's __dict__ context
+        :param template: Description tmeplate. Filled using string formatting with the event object's fields
         """
+        self.price = price
         if isinstance(price, numbers.Number):
             self.pricing = lambda event: event.duration * (price / 60.0)
         else:
             self.pricing = price
+        if isinstance(price, (int, long)):
+            # Integer hourly prices are computed exactly in cents
+            self.cents_pricing = lambda event: hourly_cents(event.duration, price)
+        else:
+            self.cents_pricing = lambda event: to_cents(self.pricing(event))
         self.filters = filters
         self.template = template
         self.ledger_account_id = ledger_account_id
 
     def invoice(self, event):
         if isinstance(event, Flight):
-            if all(f(event) for f in self.filters):
-                line = self.template %event.__dict__
-                price = self.pricing(event)
-                return [InvoiceLine(event.account_id, event.date, line, price, self, event, self.ledger_account_id)]
+            if self.batch_id is not None and event.prices is not None:
+                # Batch priced, flight carries prices of the rules it matches
+                cents = event.prices.get(self.batch_id)
+                if cents is None:
+                    return []
+            elif all(f(event) for f in self.filters):
+                cents = self.cents_pricing(event)
+            else:
+                return []
+            line = self.template %event
+            return [InvoiceLine(event.account_id, event.date, line, cents, self, event, self.ledger_account_id)]
             
         return []
 
@@ -234,6 +276,9 @@ class CappedRule(BaseRule):
       - if context value + line value is over cap, modify the line so that context value + modified line value is at cap value, add modified line to context value, and pass through modified line
       - else add line value to context value, and pass through line
     """
+    # Set by pik.vectorized.BatchCaps if the cap is applied to blocks of lines after billing
+    deferred = False
+
     def __init__(self, variable_id, cap_price, context, inner_rule):
         """
         :param variable_id: Variable to use for capping
@@ -243,23 +288,25 @@ class CappedRule(BaseRule):
         """
         self.variable_id = variable_id
         self.inner_rule = inner_rule
-        self.cap_price = decimal.Decimal(cap_price)
+        self.cap_cents = to_cents(cap_price)
         self.context = context
 
     def invoice(self, event):
         lines = self.inner_rule.invoice(event)
+        if self.deferred:
+            return lines
         return list(self._filter_lines(lines))
     
     def _filter_lines(self, lines):
         for line in lines:
             ctx_val = self.context.get(line.account_id, self.variable_id)
-            if ctx_val >= self.cap_price:
+            if ctx_val >= self.cap_cents:
                 # Already over cap, filter lines out
                 continue
-            if ctx_val + line.price > self.cap_price:
+            if ctx_val + line.cents > self.cap_cents:
                 # Cap price of line to match cap
-                line = InvoiceLine(line.account_id, line.date, line.item + ", rajattu", self.cap_price - ctx_val, self, line.event, line.ledger_account_id)
-            self.context.set(line.account_id, self.variable_id, ctx_val + line.price)
+                line = InvoiceLine(line.account_id, line.date, line.item + ", rajattu", self.cap_cents - ctx_val, self, line.event, line.ledger_account_id)
+            self.context.set(line.account_id, self.variable_id, Cents(ctx_val + line.cents))
             yield line
 
 class SetDateRule(BaseRule):
@@ -291,3 +338,24 @@ class SetLedgerYearRule(BaseRule):
             if line.ledger_year is None:
                 line.ledger_year = self.ledger_year
         return lines
+
+def inner_rules_of(rule):
+    """
+    Return list of rules directly wrapped by given rule
+    """
+    inner_rules = getattr(rule, "inner_rules", None)
+    if inner_rules is not None:
+        return list(inner_rules)
+    inner_rule = getattr(rule, "inner_rule", None)
+    if inner_rule is not None:
+        return [inner_rule]
+    return []
+
+def walk_rules(rules):
+    """
+    Generate all rules in given rule trees, parents before their inner rules
+    """
+    for rule in rules:
+        yield rule
+        for inner_rule in walk_rules(inner_rules_of(rule)):
+            yield inner_rule
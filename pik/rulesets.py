@@ -0,0 +1,157 @@
+# -*- coding: utf-8
+#
+# Rule sets that are built on demand
+#
+# Rules of each ledger year are registered as a factory together with the
+# period of events they apply to. A set is built, and prepared for billing,
+# only when the first event in its period arrives, and events are dispatched
+# only to the sets whose period contains them. A run then builds and
+# evaluates rules of the years that its input touches, not of every year in
+# the club's history.
+
+from pik.dispatch import rule_guard
+from pik.rules import BaseRule, AllRules
+import time
+
+class RuleSet(object):
+    def __init__(self, name, period, factory):
+        """
+        :param name: Name of the set, e.g. ledger year
+        :param period: Period of events the rules apply to
+        :param factory: Function that returns list of rules of the set
+        """
+        self.name = name
+        self.period = period
+        self.factory = factory
+        self.rules = None # Built and prepared rules, or None
+        self.build_time = None
+        # Number of events billed with the set, lines they produced, and time spent if timed
+        self.events = 0
+        self.lines = 0
+        self.time = 0.0
+
+    def to_json(self):
+        result = {'name': self.name, 'built': self.rules is not None}
+        if self.rules is not None:
+            result.update(build_seconds=round(self.build_time, 6), events=self.events, lines=self.lines)
+            if self.time:
+                result['seconds'] = round(self.time, 6)
+        return result
+
+class LazyRules(BaseRule):
+    """
+    Rule that applies registered rule sets to events in their periods
+
+    Sets are applied in registration order, as if they were in an AllRules.
+    Each set is built on the first event in its period, and checked not to
+    match events outside its period.
+
+    :param prepare: Function applied to rule list of each built set, e.g. compile_rules, or None
+    """
+    # Measure time spent in each set
+    timed = False
+
+    def __init__(self, prepare=None):
+        self.prepare = prepare
+        self.sets = []
+        self._sets_by_year = {}
+
+    def register(self, name, period, factory):
+        """
+        Register set of rules, see RuleSet
+        """
+        self.sets.append(RuleSet(name, period, factory))
+        self._sets_by_year.clear()
+
+    @property
+    def inner_rules(self):
+        # Rules of built sets, so that walk_rules() sees the rules in use
+        return [rule for rule_set in self.sets if rule_set.rules is not None for rule in rule_set.rules]
+
+    def build_all(self):
+        """
+        Build all sets, and return list of their rules
+        """
+        for rule_set in self.sets:
+            if rule_set.rules is None:
+                self._build(rule_set)
+        return self.inner_rules
+
+    def _build(self, rule_set):
+        start = time.time()
+        rules = list(rule_set.factory())
+        self._check_period(rule_set, rules)
+        if self.prepare is not None:
+            rules = list(self.prepare(rules))
+        rule_set.rules = rules
+        rule_set.build_time = time.time() - start
+        return rules
+
+    def _check_period(self, rule_set, rules):
+        period = rule_set.period
+        for clause in rule_guard(AllRules(rules)):
+            if clause.types == ():
+                continue
+            if not clause.periods:
+                raise ValueError("Rules of set %s are not limited to a period" % (rule_set.name,))
+            start = max(p.start for p in clause.periods)
+            end = min(p.end for p in clause.periods)
+            if start <= end and (start < period.start or period.end < end):
+                raise ValueError("Rules of set %s may match events from %s to %s, outside %s - %s" %
+                                 (rule_set.name, start, end, period.start, period.end))
+
+    def _year_sets(self, year):
+        try:
+            return self._sets_by_year[year]
+        except KeyError:
+            result = self._sets_by_year[year] = [rule_set for rule_set in self.sets
+                                                 if rule_set.period.start.year <= year <= rule_set.period.end.year]
+            return result
+
+    def require(self, date):
+        """
+        Build sets whose period contains given date
+        """
+        for rule_set in self._year_sets(date.year):
+            if rule_set.rules is None and date in rule_set.period:
+                self._build(rule_set)
+
+    def building(self, events):
+        """
+        Generate given events, building sets for them as they pass
+
+        Use before stages that must see the rules of an event before it is
+        billed, e.g. pik.vectorized.BatchPricer.priced.
+        """
+        for event in events:
+            self.require(event.date)
+            yield event
+
+    def invoice(self, event):
+        date = event.date
+        result = []
+        for rule_set in self._year_sets(date.year):
+            if date in rule_set.period:
+                rules = rule_set.rules
+                if rules is None:
+                    rules = self._build(rule_set)
+                n_lines = len(result)
+                if self.timed:
+                    start = time.time()
+                    for rule in rules:
+                        result.extend(rule.invoice(event))
+                    rule_set.time += time.time() - start
+                else:
+                    for rule in rules:
+                        result.extend(rule.invoice(event))
+                rule_set.events += 1
+                rule_set.lines += len(result) - n_lines
+        return result
+
+    def report(self):
+        """
+        Return description of built and unbuilt sets, e.g. for logging
+        """
+        built = ["%s (%.3f s)" % (rule_set.name, rule_set.build_time) for rule_set in self.sets if rule_set.rules is not None]
+        unbuilt = [unicode(rule_set.name) for rule_set in self.sets if rule_set.rules is None]
+        return "Rule sets built: %s; not built: %s" % (", ".join(built) or "none", ", ".join(unbuilt) or "none")
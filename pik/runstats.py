@@ -0,0 +1,153 @@
+# -*- coding: utf-8
+#
+# Timing and counters of billing runs
+#
+# Stages of a run are chained lazily, e.g. flight logs are parsed while
+# events are billed, so each stage is timed only while it runs itself. Time
+# of a stage excludes time of the stages it pulls items from.
+
+import contextlib
+import datetime as dt
+import itertools
+import os
+import resource
+import time
+
+class Stage(object):
+    __slots__ = ('name', 'wall', 'cpu', 'items', 'wall_start', 'cpu_start')
+
+    def __init__(self, name):
+        self.name = name
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.items = 0
+        self.wall_start = None
+        self.cpu_start = None
+
+    def to_json(self):
+        result = {'name': self.name, 'wall_seconds': round(self.wall, 6), 'cpu_seconds': round(self.cpu, 6)}
+        if self.items:
+            result['items'] = self.items
+            if self.wall > 0:
+                result['items_per_second'] = round(self.items / self.wall, 1)
+        return result
+
+class RunStats(object):
+    """
+    Wall and CPU time and item counts of run stages, and other counters
+
+    :param enabled: Record stages and counters, if False the methods do nothing
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.started = dt.datetime.now()
+        self.start_wall = time.time()
+        self.start_cpu = time.clock()
+        self.stages = []
+        self.counters = {}
+        self._stages_by_name = {}
+        self._running = []
+
+    def _stage(self, name):
+        try:
+            return self._stages_by_name[name]
+        except KeyError:
+            stage = self._stages_by_name[name] = Stage(name)
+            self.stages.append(stage)
+            return stage
+
+    def _enter(self, stage):
+        wall, cpu = time.time(), time.clock()
+        if self._running:
+            outer = self._running[-1]
+            outer.wall += wall - outer.wall_start
+            outer.cpu += cpu - outer.cpu_start
+        stage.wall_start, stage.cpu_start = wall, cpu
+        self._running.append(stage)
+
+    def _exit(self):
+        wall, cpu = time.time(), time.clock()
+        stage = self._running.pop()
+        stage.wall += wall - stage.wall_start
+        stage.cpu += cpu - stage.cpu_start
+        if self._running:
+            outer = self._running[-1]
+            outer.wall_start, outer.cpu_start = wall, cpu
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Context manager that times its body as given stage
+        """
+        if not self.enabled:
+            yield
+            return
+        self._enter(self._stage(name))
+        try:
+            yield
+        finally:
+            self._exit()
+
+    def timed(self, name, items, block_size=1000):
+        """
+        Return iterator over given items that times producing them as given
+        stage, and counts them
+
+        Items are produced in blocks, so that timing doesn't slow down
+        stages with many cheap items.
+        """
+        if not self.enabled:
+            return items
+        return self._timed(self._stage(name), iter(items), block_size)
+
+    def _timed(self, stage, items, block_size):
+        while True:
+            self._enter(stage)
+            try:
+                block = list(itertools.islice(items, block_size))
+            finally:
+                self._exit()
+            if not block:
+                return
+            stage.items += len(block)
+            for item in block:
+                yield item
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def to_json(self):
+        """
+        Return stages, counters, total times and peak memory use as JSON-like dict
+        """
+        wall = time.time() - self.start_wall
+        times = os.times()
+        return {'started': self.started.isoformat(),
+                'wall_seconds': round(wall, 6),
+                'cpu_seconds': round(time.clock() - self.start_cpu, 6),
+                'children_cpu_seconds': round(times[2] + times[3], 6),
+                'other_wall_seconds': round(wall - sum(stage.wall for stage in self.stages), 6),
+                # Kilobytes on Linux
+                'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                'children_peak_rss_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+                'stages': [stage.to_json() for stage in self.stages],
+                'counters': dict(self.counters)}
+
+    def format_table(self):
+        """
+        Return stages as a text table
+        """
+        report = self.to_json()
+        rows = [("Stage", "Wall s", "CPU s", "Items", "Items/s")]
+        for stage in report['stages']:
+            rows.append((stage['name'], "%.3f" % stage['wall_seconds'], "%.3f" % stage['cpu_seconds'],
+                         str(stage.get('items', "")), "%.0f" % stage['items_per_second'] if 'items_per_second' in stage else ""))
+        rows.append(("other", "%.3f" % report['other_wall_seconds'], "", "", ""))
+        rows.append(("total", "%.3f" % report['wall_seconds'], "%.3f" % report['cpu_seconds'], "", ""))
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        lines = [row[0].ljust(widths[0]) + "".join("  " + value.rjust(width) for (value, width) in zip(row[1:], widths[1:])) for row in rows]
+        lines.append("Peak RSS %d kB, children %d kB" % (report['peak_rss_kb'], report['children_peak_rss_kb']))
+        for name in sorted(report['counters']):
+            lines.append("%s: %s" % (name, report['counters'][name]))
+        return "\n".join(lines)
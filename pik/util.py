@@ -1,5 +1,6 @@
 # -*- coding: utf-8
 import datetime as dt
+from pik.money import format_cents
 
 class Period(object):
     def __init__(self, start, end):
@@ -17,6 +18,20 @@ class Period(object):
     def __contains__(self, date):
         return self.start <= date and date <= self.end
 
+class Record(object):
+    """
+    Base class for records with __slots__
+
+    Fields of a record can be used in templates, e.g. "%(date)s" % record.
+    """
+    __slots__ = ()
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name)
+
 def parse_iso8601_date(datestr):
     try:
         return dt.date(*map(int, datestr.split('-')))
@@ -25,56 +40,107 @@ def parse_iso8601_date(datestr):
 
 FORMAT_2015 = "2015"
 FORMAT_2014 = "2014"
-def format_invoice(invoice, additional_details="", format=FORMAT_2015):
+# Templates of invoice text formats, by format id
+_templates = {}
 
-    dateformat = "%d.%m.%Y"
-    spacer = "---------------------------"
-    due_in = dt.timedelta(14)
-
-    total_price = sum(l.price for l in invoice.lines)
-
-    ret = \
-          u"PIK ry jäsenlaskutus, viite %s\n" % invoice.account_id + spacer + "\n"
-
-    if format == FORMAT_2015:
-        ret += u"\nLentotilin saldo: %.2f EUR" % (total_price) + "\n" + spacer + "\n\n"
-    elif format == FORMAT_2014 and total_price <= 0:
-            ret += u"Lentotilin saldo: %.2f EUR" % (total_price) + "\n" + spacer + "\n\n"
-        
-    if total_price > 0:
-        ret += u"Laskun päivämäärä: " + invoice.date.strftime(dateformat) + "\n\n" + \
-               u"Saaja: Polyteknikkojen Ilmailukerho ry\n" + \
-               u"Saajan tilinumero: FI24 1309 3000 1124 58 (Nordea)\n\n" + \
-               u"Viitenumero (PIK-viite): " + invoice.account_id + "\n" + \
-               u"Laskun eräpäivä: " + (invoice.date + due_in).strftime(dateformat) + "\n\n" + \
-               u"Maksettavaa: %.2f EUR" % (total_price) + "\n" + spacer + "\n\n"
-    else:
+def invoice_template(format=FORMAT_2015):
+    """
+    Return InvoiceTemplate of given format id
+    """
+    try:
+        return _templates[format]
+    except KeyError:
+        template = _templates[format] = InvoiceTemplate(format)
+        return template
+
+class InvoiceTemplate(object):
+    """
+    Text of invoices in given format
+
+    Fixed parts of the text are prepared once per format. Lines are sorted
+    by date once, and the invoice is rendered as a list of pieces that are
+    joined, or written to a file as they are produced.
+    """
+    def __init__(self, format=FORMAT_2015):
+        self.format = format
+        spacer = u"---------------------------"
+        self.due_in = dt.timedelta(14)
+        self.head = u"PIK ry jäsenlaskutus, viite %s\n" + spacer + u"\n"
         if format == FORMAT_2015:
-            ret += u"Ei maksettavaa kerholle, ennakkomaksuja kerholla %.2f EUR." %(-total_price) + "\n" + spacer + "\n\n"
+            self.balance = u"\nLentotilin saldo: %s EUR\n" + spacer + u"\n\n"
+            self.nothing_due = u"Ei maksettavaa kerholle, ennakkomaksuja kerholla %s EUR.\n" + spacer + u"\n\n"
         else:
-            ret += u"Ei maksettavaa kerholle." + "\n" + spacer + "\n\n"
-
-    ret += additional_details + "\n\n"
-
-    ret += u"Tapahtumien erittely: \n\n"
+            # Format 2014 shows the balance only when there's nothing to pay
+            self.balance = u"Lentotilin saldo: %s EUR\n" + spacer + u"\n\n" if format == FORMAT_2014 else None
+            self.nothing_due = u"Ei maksettavaa kerholle.\n" + spacer + u"\n\n"
+        self.due = (u"Laskun päivämäärä: %s\n\n" +
+                    u"Saaja: Polyteknikkojen Ilmailukerho ry\n" +
+                    u"Saajan tilinumero: FI24 1309 3000 1124 58 (Nordea)\n\n" +
+                    u"Viitenumero (PIK-viite): %s\n" +
+                    u"Laskun eräpäivä: %s\n\n" +
+                    u"Maksettavaa: %s EUR\n" + spacer + u"\n\n")
+        bullet = u" * " if format == FORMAT_2015 else u""
+        self.line = bullet + u"%s %s:  %s\n"
+        self.zero_lines_head = u"\nMyös seuraavat tapahtumat (à 0 EUR) on huomioitu:\n\n"
+        self.zero_line = bullet + u"%s %s\n"
+        self._dates = {}
+
+    def _date(self, date):
+        # Same as date.strftime("%d.%m.%Y"), lines of a round have few distinct dates
+        try:
+            return self._dates[date]
+        except KeyError:
+            result = self._dates[date] = u"%02d.%02d.%04d" % (date.day, date.month, date.year)
+            return result
+
+    def pieces(self, invoice, additional_details=""):
+        """
+        Return text of given invoice as a list of strings
+        """
+        priced = []
+        zero = []
+        total_cents = 0
+        for line in sorted(invoice.lines, key=lambda line: line.date):
+            if line.cents == 0:
+                zero.append(line)
+            else:
+                priced.append(line)
+                total_cents += line.cents
+
+        result = [self.head % invoice.account_id]
+        if self.balance is not None and (self.format == FORMAT_2015 or total_cents <= 0):
+            result.append(self.balance % format_cents(total_cents))
+        if total_cents > 0:
+            result.append(self.due % (self._date(invoice.date), invoice.account_id, self._date(invoice.date + self.due_in),
+                                      format_cents(total_cents)))
+        elif self.format == FORMAT_2015:
+            result.append(self.nothing_due % format_cents(-total_cents))
+        else:
+            result.append(self.nothing_due)
+        result.append(additional_details)
+        result.append(u"\n\nTapahtumien erittely: \n\n")
 
-    for line in sorted(invoice.lines, key=lambda line: line.date):
-        if line.price == 0:
-            continue
-        if format == FORMAT_2015:
-            ret += " * "
-        ret += "%s %s:  %.2f" % (line.date.strftime(dateformat), line.item, line.price) +"\n"
-    ret += "\n"
+        date, template = self._date, self.line
+        result.extend([template % (date(line.date), line.item, format_cents(line.cents)) for line in priced])
+        result.append(self.zero_lines_head)
+        template = self.zero_line
+        result.extend([template % (date(line.date), line.item) for line in zero])
+        return result
 
-    ret += u"Myös seuraavat tapahtumat (à 0 EUR) on huomioitu:\n\n"
+    def render(self, invoice, additional_details=""):
+        return u"".join(self.pieces(invoice, additional_details))
 
-    for line in sorted(invoice.lines, key=lambda line: line.date):
-        if not line.price == 0:
-            continue
+    def write(self, f, invoice, additional_details="", encoding="utf-8"):
+        """
+        Write text of given invoice into given binary file
+        """
+        f.writelines([piece.encode(encoding) for piece in self.pieces(invoice, additional_details)])
 
-        
-        if format == FORMAT_2015:
-            ret += " * "
-        ret += u"%s %s" % (line.date.strftime(dateformat), line.item) +"\n"
+def format_invoice(invoice, additional_details="", format=FORMAT_2015):
+    return invoice_template(format).render(invoice, additional_details)
 
-    return ret
+def write_invoice(f, invoice, additional_details="", format=FORMAT_2015):
+    """
+    Write text of given invoice into given binary file, encoded as UTF-8
+    """
+    invoice_template(format).write(f, invoice, additional_details)
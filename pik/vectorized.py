@@ -0,0 +1,395 @@
+# -*- coding: utf-8
+#
+# Batch pricing and capping with NumPy
+#
+# Most FlightRules have a constant hourly price and filters that only look
+# at fields of the flight. Such rules are matched and priced for a block of
+# flights at once with array operations, and each flight carries the prices
+# of the rules that it matched, which FlightRule.invoice looks up instead of
+# applying its filters. Rules with other filters, such as SinceDateFilter,
+# or with pricing functions are evaluated one flight at a time as before.
+#
+# CappedRules whose results don't affect other rules are applied to blocks
+# of invoice lines after billing, with a cumulative sum per account instead
+# of a context lookup and update per line.
+
+from pik.billing import InvoiceLine
+from pik.dispatch import IndexedAllRules
+from pik.flights import Flight
+from pik.money import Cents, to_cents
+from pik.registry import RULES
+from pik.rules import AllRules, FlightRule, SimpleRule, CappedRule, SetDateRule, SetLedgerYearRule, SinceDateFilter, PeriodFilter, AircraftFilter, PurposeFilter, NegationFilter, TransferTowFilter, InvoicingChargeFilter, flightFilter, inner_rules_of, walk_rules
+import itertools
+
+# Prices of a flight that matched no batch priced rule
+_NO_PRICES = {}
+
+def _filter_key(f):
+    """
+    Return hashable key that identifies what given filter matches, or
+    None if the filter can't be evaluated on a block
+    """
+    cls = f.__class__
+    if cls is PeriodFilter:
+        return (cls, f.period.start, f.period.end)
+    if cls in (AircraftFilter, PurposeFilter):
+        values = f.aircraft if cls is AircraftFilter else f.purposes
+        return (cls, frozenset(values))
+    if cls in (TransferTowFilter, InvoicingChargeFilter):
+        return (cls,)
+    if cls is NegationFilter:
+        inner_key = _filter_key(f.filter)
+        return None if inner_key is None else (cls, inner_key)
+    if f is flightFilter:
+        return (flightFilter,)
+    return None
+
+def is_batch_priceable(rule):
+    """
+    Is given rule a FlightRule with a numeric hourly price and only filters
+    that can be evaluated on a block of flights
+    """
+    return (rule.__class__ is FlightRule and type(rule.price) in (int, long, float) and
+            all(_filter_key(f) is not None for f in rule.filters))
+
+class _Block(object):
+    """
+    Columns of a block of flights, with cached filter masks and prices
+    """
+    def __init__(self, np, flights):
+        self.np = np
+        n = len(flights)
+        self.n = n
+        self.date = np.fromiter((f.date.toordinal() for f in flights), np.int64, n)
+        self.duration = np.fromiter((f.duration for f in flights), np.int64, n)
+        self.transfer_tow = np.fromiter((bool(f.transfer_tow) for f in flights), np.bool_, n)
+        self.invoicing_comment = np.fromiter((bool(f.invoicing_comment) for f in flights), np.bool_, n)
+        self.aircraft, self.aircraft_codes = self._codes([f.aircraft for f in flights])
+        self.purpose, self.purpose_codes = self._codes([f.purpose for f in flights])
+        self._masks = {}
+        self._cents = {}
+
+    def _codes(self, values):
+        codes = {}
+        column = self.np.fromiter((codes.setdefault(value, len(codes)) for value in values), self.np.int32, len(values))
+        return column, codes
+
+    def mask(self, key):
+        """
+        Return boolean array of flights that match filter with given key
+        """
+        try:
+            return self._masks[key]
+        except KeyError:
+            pass
+        np = self.np
+        cls = key[0]
+        if cls is PeriodFilter:
+            mask = (self.date >= key[1].toordinal()) & (self.date <= key[2].toordinal())
+        elif cls is AircraftFilter:
+            mask = np.in1d(self.aircraft, [self.aircraft_codes[a] for a in key[1] if a in self.aircraft_codes])
+        elif cls is PurposeFilter:
+            mask = np.in1d(self.purpose, [self.purpose_codes[p] for p in key[1] if p in self.purpose_codes])
+        elif cls is TransferTowFilter:
+            mask = self.transfer_tow
+        elif cls is InvoicingChargeFilter:
+            mask = self.invoicing_comment
+        elif cls is NegationFilter:
+            mask = ~self.mask(key[1])
+        else:
+            mask = np.ones(self.n, np.bool_)
+        self._masks[key] = mask
+        return mask
+
+    def cents(self, price):
+        """
+        Return prices in cents of the flights at given hourly price
+        """
+        try:
+            return self._cents[price]
+        except KeyError:
+            pass
+        if isinstance(price, float):
+            # Rounded the same way as FlightRule, once per distinct duration
+            durations, inverse = self.np.unique(self.duration, return_inverse=True)
+            per_hour = price / 60.0
+            cents = self.np.array([to_cents(duration * per_hour) for duration in durations.tolist()], self.np.int64)[inverse]
+        else:
+            # Same as hourly_cents
+            cents = (self.duration * (price * 5) + 1) // 3
+        self._cents[price] = cents
+        return cents
+
+class BatchPricer(object):
+    """
+    Prices flights in blocks for FlightRules that can be batch priced
+
+    Adding rules to a pricer numbers the batch priced rules in them. Use
+    only one pricer with the same rules.
+
+    :param rules: Rule trees
+    :param block_size: Number of events to price at a time
+    """
+    def __init__(self, rules=(), block_size=10000):
+        import numpy
+        self.np = numpy
+        self.block_size = block_size
+        self.rules = []
+        self.add(rules)
+
+    def add(self, rules):
+        """
+        Add rule trees to price, flights priced before have no prices for them
+        """
+        for rule in walk_rules(rules):
+            if is_batch_priceable(rule) and rule.batch_id is None:
+                rule.batch_id = len(self.rules)
+                self.rules.append((rule.batch_id, [_filter_key(f) for f in rule.filters], rule.price))
+
+    def price(self, flights):
+        """
+        Set prices of given flights, as dict from batch id of matching rule to price in cents
+        """
+        np = self.np
+        if not flights:
+            return
+        block = _Block(np, flights)
+        positions, rule_ids, cents = [], [], []
+        for batch_id, keys, price in self.rules:
+            mask = None
+            for key in keys:
+                mask = block.mask(key) if mask is None else mask & block.mask(key)
+            matched = np.flatnonzero(mask) if mask is not None else np.arange(block.n)
+            if len(matched):
+                positions.append(matched)
+                rule_ids.append(np.full(len(matched), batch_id, np.int64))
+                cents.append(block.cents(price)[matched])
+        if not positions:
+            for flight in flights:
+                flight.prices = _NO_PRICES
+            return
+        positions = np.concatenate(positions)
+        order = np.argsort(positions, kind="mergesort")
+        rule_ids = np.concatenate(rule_ids)[order].tolist()
+        cents = np.concatenate(cents)[order].tolist()
+        ends = np.cumsum(np.bincount(positions, minlength=block.n)).tolist()
+        start = 0
+        for flight, end in itertools.izip(flights, ends):
+            flight.prices = dict(itertools.izip(rule_ids[start:end], cents[start:end])) if end > start else _NO_PRICES
+            start = end
+
+    def priced(self, events):
+        """
+        Generate given events, with prices set on flights
+        """
+        events = iter(events)
+        while True:
+            block = list(itertools.islice(events, self.block_size))
+            if not block:
+                return
+            self.price([event for event in block if isinstance(event, Flight)])
+            for event in block:
+                yield event
+
+def _context_variables(rule):
+    """
+    Return list of (context, variable id) that given rule or its filters
+    read or write, not including inner rules
+    """
+    if isinstance(rule, (CappedRule, SetDateRule)):
+        return [(rule.context, rule.variable_id)]
+    result = []
+    filters = list(getattr(rule, "filters", []))
+    while filters:
+        f = filters.pop()
+        if isinstance(f, NegationFilter):
+            filters.append(f.filter)
+        elif isinstance(f, SinceDateFilter):
+            result.append((f.ctx, f.variable_id))
+    return result
+
+class BatchCaps(object):
+    """
+    Applies CappedRules to blocks of invoice lines
+
+    A CappedRule is deferred if all rules above it are AllRules,
+    SetLedgerYearRules or deferred CappedRules, all rules below it are AllRules, deferred CappedRules,
+    FlightRules or SimpleRules that appear only once in the rule trees, and
+    no other rule uses its context variable. A deferred CappedRule passes
+    its lines through, and capped() applies the cap to them later. Lines
+    are capped in the same order and with the same results as by the
+    CappedRules themselves.
+
+    Other rules than those in pik.rules must not use the context variables
+    of CappedRules.
+
+    :param rules: Rule trees
+    :param block_size: Number of lines to cap at a time
+    """
+    def __init__(self, rules=(), block_size=10000):
+        import numpy
+        self.np = numpy
+        self.block_size = block_size
+        # Deferred caps, inner caps first, and ids of the leaf rules below each
+        self.caps = []
+        self.leaf_ids = {}
+        # Ledger year of capped lines, set by SetLedgerYearRules above each cap
+        self.ledger_years = {}
+        # Rules that use each context variable, and variables of deferred caps
+        self.users = {}
+        self.deferred_variables = set()
+        self.add(rules)
+
+    def add(self, rules):
+        """
+        Add rule trees, deferring the caps in them that can be deferred
+
+        Added rules must not use context variables of caps deferred before.
+        """
+        np = self.np
+        rules = list(rules)
+        counts = {}
+        for rule in walk_rules(rules):
+            counts[id(rule)] = counts.get(id(rule), 0) + 1
+        for rule in walk_rules(rules):
+            for (ctx, variable_id) in _context_variables(rule):
+                key = (id(ctx), variable_id)
+                if key in self.deferred_variables:
+                    raise ValueError("Context variable of a deferred cap is used by added rules: " + variable_id)
+                self.users.setdefault(key, set()).add(id(rule))
+        # Drop caps that share their variable with another rule, and caps
+        # above and below those, until the remaining caps are consistent
+        candidates = None
+        while True:
+            deferred = set()
+            for rule in self._reachable_caps(rules, candidates):
+                if (counts[id(rule)] == 1 and len(self.users[(id(rule.context), rule.variable_id)]) == 1 and
+                    self._can_defer_below(rule, candidates, counts)):
+                    deferred.add(id(rule))
+            if deferred == candidates:
+                break
+            candidates = deferred
+        caps = []
+        for rule in reversed(list(walk_rules(rules))):
+            if id(rule) in candidates and not rule.deferred:
+                rule.deferred = True
+                caps.append(rule)
+                self.leaf_ids[id(rule)] = []
+                self.deferred_variables.add((id(rule.context), rule.variable_id))
+        self.caps.extend(caps)
+        for rule in rules:
+            self._add_chains(rule, (), None)
+        for cap in caps:
+            self.leaf_ids[id(cap)] = np.array(self.leaf_ids[id(cap)], np.int64)
+
+    def _reachable_caps(self, rules, candidates):
+        """
+        Generate CappedRules that are below only AllRules, SetLedgerYearRules
+        and given candidate caps, or any caps if candidates is None
+        """
+        for rule in rules:
+            if rule.__class__ is CappedRule:
+                yield rule
+                if candidates is not None and id(rule) not in candidates:
+                    continue
+            if rule.__class__ in (AllRules, IndexedAllRules, SetLedgerYearRule, CappedRule):
+                for cap in self._reachable_caps(inner_rules_of(rule), candidates):
+                    yield cap
+
+    def _can_defer_below(self, cap, candidates, counts):
+        for rule in walk_rules([cap.inner_rule]):
+            if rule.__class__ in (FlightRule, SimpleRule):
+                if counts[id(rule)] != 1:
+                    return False
+            elif rule.__class__ is CappedRule:
+                if candidates is not None and id(rule) not in candidates:
+                    return False
+            elif rule.__class__ not in (AllRules, IndexedAllRules):
+                return False
+        return True
+
+    def _add_chains(self, rule, chain, ledger_year):
+        if rule.__class__ is SetLedgerYearRule:
+            ledger_year = rule.ledger_year
+        elif rule.__class__ is CappedRule and rule.deferred:
+            chain = (rule,) + chain
+            self.ledger_years[id(rule)] = ledger_year
+        elif rule.__class__ in (FlightRule, SimpleRule):
+            for cap in chain:
+                self.leaf_ids[id(cap)].append(RULES.id_of(rule))
+            return
+        for inner_rule in inner_rules_of(rule):
+            self._add_chains(inner_rule, chain, ledger_year)
+
+    def capped(self, lines):
+        """
+        Generate given lines, with caps of deferred CappedRules applied
+        """
+        lines = iter(lines)
+        while True:
+            block = list(itertools.islice(lines, self.block_size))
+            if not block:
+                return
+            for line in self._cap_block(block):
+                yield line
+
+    def _cap_block(self, lines):
+        np = self.np
+        rule_ids = np.fromiter((-1 if line.rule_id is None else line.rule_id for line in lines), np.int64, len(lines))
+        alive = np.ones(len(lines), np.bool_)
+        for cap in self.caps:
+            positions = np.flatnonzero(np.in1d(rule_ids, self.leaf_ids[id(cap)]) & alive)
+            if len(positions):
+                self._apply_cap(cap, lines, positions, alive)
+        if alive.all():
+            return lines
+        return [line for line in lines if line is not None]
+
+    def _apply_cap(self, cap, lines, positions, alive):
+        """
+        Cap lines at given positions, in order, replacing dropped lines with None
+        """
+        np = self.np
+        ctx, variable_id, cap_cents = cap.context, cap.variable_id, cap.cap_cents
+        capped = [lines[i] for i in positions.tolist()]
+        group_of = {}
+        groups = np.array([group_of.setdefault(line.account_id, len(group_of)) for line in capped], np.int64)
+        accounts = sorted(group_of, key=group_of.get)
+        start_values = np.array([ctx.get(account_id, variable_id) for account_id in accounts], np.int64)
+        cents = np.array([line.cents for line in capped], np.int64)
+
+        # Lines of each account in order, and running sums within accounts
+        order = np.argsort(groups, kind="mergesort")
+        groups, cents = groups[order], cents[order]
+        first = np.ones(len(groups), np.bool_)
+        first[1:] = groups[1:] != groups[:-1]
+        starts = np.flatnonzero(first)
+        ends = np.append(starts[1:], len(groups)) - 1
+        group_no = np.cumsum(first) - 1
+        sums = np.cumsum(cents)
+        sums -= (sums - cents)[starts][group_no]
+        # Context value after each line if no line were capped
+        reached = start_values[groups] + sums
+        crossed = reached >= cap_cents
+        n_crossed = np.cumsum(crossed)
+        n_crossed -= (n_crossed - crossed)[starts][group_no]
+        # Lines up to and including the first one that reaches the cap are kept
+        kept = (start_values[groups] < cap_cents) & (n_crossed - crossed == 0)
+        trimmed = kept & (reached > cap_cents)
+
+        positions = positions[order]
+        dropped = positions[~kept]
+        alive[dropped] = False
+        for i in dropped.tolist():
+            lines[i] = None
+        ledger_year = self.ledger_years[id(cap)]
+        for i, before in itertools.izip(positions[trimmed].tolist(), (reached - cents)[trimmed].tolist()):
+            line = lines[i]
+            capped_line = InvoiceLine(line.account_id, line.date, line.item + ", rajattu", cap_cents - before, cap, None, line.ledger_account_id, ledger_year)
+            # The event may be gone already, but its id is still valid
+            capped_line.event_id = line.event_id
+            lines[i] = capped_line
+        final_values = np.where(n_crossed[ends] > 0, cap_cents, start_values + sums[ends]).tolist()
+        for account_id, start_value, final_value in itertools.izip(accounts, start_values.tolist(), final_values):
+            if start_value < cap_cents:
+                ctx.set(account_id, variable_id, Cents(final_value))
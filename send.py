@@ -4,17 +4,46 @@ import sys
 import json
 import smtplib
 import os
-import time
+import re
 from email.mime.text import MIMEText
 import getpass
+from pik.delivery import Delivery, DeliveryPool, SENT
 
-def read_recipient_file(fname, recipient_id):
+# Loose check of an address, to catch typos and swapped columns
+EMAIL_RE = re.compile(r"^[^@\s,;<>]+@[^@\s,;<>]+\.[^@\s,;<>]+$")
+
+def read_recipient_index(fname):
+    """
+    Read tab-separated file of e-mail address and recipient id rows into a
+    dict of recipient id to list of addresses
+
+    A recipient may have several rows, or several comma-separated
+    addresses in one row. Repeated addresses are ignored.
+
+    :return: (index, problems), where problems is a list of descriptions of
+             invalid rows, invalid addresses and repeated addresses
+    """
+    index = {}
+    problems = []
     with open(fname, "rb") as file:
-        for row in csv.reader(file, delimiter="\t"):
-            email_addr,id = row
-            if id == recipient_id:
-                return email_addr
-    return None
+        for line_number, row in enumerate(csv.reader(file, delimiter="\t"), 1):
+            if not row or not "".join(row).strip():
+                continue
+            if len(row) != 2:
+                problems.append("%s:%d: expected address and id, got %r" % (fname, line_number, row))
+                continue
+            email_addrs, id = row
+            id = id.strip()
+            addrs = index.setdefault(id, [])
+            for email_addr in email_addrs.split(","):
+                email_addr = email_addr.strip()
+                if not EMAIL_RE.match(email_addr):
+                    problems.append("%s:%d: invalid address %r for %s" % (fname, line_number, email_addr, id))
+                elif email_addr in addrs:
+                    problems.append("%s:%d: repeated address %s for %s" % (fname, line_number, email_addr, id))
+                else:
+                    addrs.append(email_addr)
+    return index, problems
 
 def make_msg(sender_addr, recipient_addr, title, body):
     msg = MIMEText(body, "plain", "utf-8")
@@ -40,19 +69,23 @@ def send(conf, email_addr, msg_lines):
 
   
     
-def get_connection(conf):
+def get_connection(conf, smtp_password=None):
     # Function for establishing and returning an smtp connection
-    # to given host
+    # to given host, host may be given as host:port
     smtps_host = conf["smtps_host"]
 
-    conn = smtplib.SMTP_SSL(smtps_host)
+    if conf.get("smtp_ssl", True):
+        conn = smtplib.SMTP_SSL(smtps_host)
+    else:
+        # E.g. a local smtpd for testing
+        conn = smtplib.SMTP(smtps_host)
     conn.ehlo_or_helo_if_needed()
-        
-    smtp_user = conf["smtp_user"]
-    smtp_password = conf["smtp_password"]
-    # smtp_password = getpass.getpass()
 
-    conn.login(smtp_user, smtp_password)
+    if "smtp_user" in conf:
+        smtp_user = conf["smtp_user"]
+        if smtp_password is None:
+            smtp_password = conf["smtp_password"]
+        conn.login(smtp_user, smtp_password)
     
     return conn
     
@@ -60,60 +93,61 @@ def get_connection(conf):
 def read_config(conf_file_name):
     return json.load(open(conf_file_name, "rb"))
     
+def invoice_recipients(dir_name, index):
+    """
+    Return list of (recipient id, invoice file name, addresses) of invoices
+    in given directory, addresses are empty if there are none in index
+    """
+    result = []
+    for fname in sorted(os.listdir(dir_name)):
+        if fname.endswith(".txt"):
+            recipient_id = fname.replace(".txt","")
+            result.append((recipient_id, os.path.join(dir_name, fname), index.get(recipient_id, [])))
+    return result
+
+def make_deliveries(conf, recipients):
+    for recipient_id, path, recipient_addrs in recipients:
+        title = conf["title"] % {"id":recipient_id}
+        body = open(path, "rb").read()
+        # One message per address, so that retrying one doesn't resend the others
+        for recipient_addr in recipient_addrs:
+            msg = make_msg(conf["sender_address"], recipient_addr, title, body)
+            yield Delivery(recipient_id, recipient_addr, msg.as_string())
+
 def main():
     args = sys.argv[1:]
     if len(args) >= 2:
         conf = read_config(args[0])
-        email_file = conf["email_file"]
 
-        # Get SMTP connection:
-        conn = get_connection(conf)
-        
-        dir_name = args[1]
-        for fname in os.listdir(dir_name):
-            if fname.endswith(".txt"):
-                path = os.path.join(dir_name, fname)
-                recipient_id = fname.replace(".txt","")
-
-                title = conf["title"] % {"id":recipient_id}
-                body = open(path, "rb").read()
-        
-                recipient_addr = read_recipient_file(email_file, recipient_id)
-        
-                print >> sys.stderr, "Sending", recipient_id, recipient_addr
-                if recipient_addr:
-                    msg = make_msg(conf["sender_address"], recipient_addr, title, body)
-                    while True:
-                        try:
-                            #send(conf, recipient_addr, msg.as_string()) # Replaced with send_v2:
-                            #send_v2(conn, conf, recipient_addr, msg.as_string())
-                            # TBD: check if conn is connected
-                            conn.sendmail(conf["sender_address"], recipient_addr, msg.as_string())
-                            print >> sys.stderr, "Sent", recipient_id, recipient_addr
-                            break # No need to retry
-                        except smtplib.SMTPRecipientsRefused, e:
-                            error_code = e.recipients.values()[0][0]
-                            if error_code == 501:
-                                print >> sys.stderr, "Invalid recipient, not retrying", recipient_id, recipient_addr, e
-                                break # Break retry loop
-                            elif error_code == 451:
-                                print >> sys.stderr, "Throttled, retrying later", recipient_id, recipient_addr, e
-                            else:
-                                print >> sys.stderr, "Unknown error, not retrying", recipient_id, recipient_addr, e
-                                break # Break retry loop
-                        except Exception, e:
-                            print >> sys.stderr, "Unknown exception type, not retrying", recipient_id, recipient_addr, e
-                            break # Break retry loop
-                        time.sleep(60)
-                else:
-                    print >> sys.stderr, "No e-mail address for", recipient_id
-                   
-        # End SMTP connection
-        conn.quit()
-        print "SMTP connection closed"
+        # Report all problems with recipients before sending anything
+        index, problems = read_recipient_index(conf["email_file"])
+        for problem in problems:
+            print >> sys.stderr, problem
+        recipients = invoice_recipients(args[1], index)
+        for recipient_id, path, recipient_addrs in recipients:
+            if not recipient_addrs:
+                print >> sys.stderr, "No e-mail address for", recipient_id
+
+        smtp_password = None
+        if "smtp_user" in conf and "smtp_password" not in conf:
+            smtp_password = getpass.getpass()
+
+        pool = DeliveryPool(lambda: get_connection(conf, smtp_password), conf["sender_address"],
+                            connections=conf.get("smtp_connections", 1),
+                            rate=conf.get("smtp_rate"),
+                            burst=conf.get("smtp_burst", 1),
+                            max_attempts=conf.get("smtp_max_attempts", 10),
+                            retry_delay=conf.get("smtp_retry_delay", 60),
+                            max_retry_delay=conf.get("smtp_max_retry_delay", 600))
+        deliveries = pool.send_all(make_deliveries(conf, recipients))
+
+        failed = [d for d in deliveries if d.status != SENT]
+        print "Sent %d messages, %d failed" % (len(deliveries) - len(failed), len(failed))
+        for delivery in failed:
+            print >> sys.stderr, "Failed", delivery.recipient_id, delivery.recipient_addr, delivery.error
         
     else:
-        print "Usage: send.py conf-file recipient-id"
+        print "Usage: send.py conf-file invoice-dir"
     
 
 if __name__ == '__main__':